@@ -5,6 +5,7 @@ import pandas as pd
 import os
 from os.path import join
 import numpy as np
+from Analysis.index import index_rollup, add_quarter
 
 
 # A function to estimate the emissions intensity of each fuel over time, making
@@ -58,17 +59,6 @@ def facility_index_gen(eia_facility, epa, emission_factor_path,
         region: name of region, state, or other geography
     """
 
-    # Create some helper functions to add datetime and quarter columns
-    def add_datetime(df, year='year', month='month'):
-        df['datetime'] = pd.to_datetime(df[year].astype(str) + '-' +
-                                        df[month].astype(str),
-                                        format='%Y-%m')
-
-    def add_quarter(df, year='year', month='month'):
-        add_datetime(df, year, month)
-        df['quarter'] = df['datetime'].dt.quarter
-
-
     # ### Facility generation and CO2 emissions
     # eia_facility = pd.read_csv(facility_path, parse_dates=['datetime'],
     #                            low_memory=False)
@@ -195,68 +185,14 @@ def facility_index_gen(eia_facility, epa, emission_factor_path,
 
 
     # ## Final index values
-
-    # Start with some helper functions to convert units and calculate % change from 2005 annual value
-
-    def g2lb(df):
-        """
-        Convert g/kWh to lb/MWh and add a column to the df
-        """
-        kg2lb = 2.2046
-        df['index (lb/MWh)'] = df['index (g/kWh)'] * kg2lb
-
-    def change_since_2005(df):
-        """
-        Calculate the % difference from 2005 and add as a column in the df
-        """
-        # first calculate the index in 2005
-        index_2005 = ((df.loc[df['year'] == 2005, 'index (g/kWh)'] *
-                       df.loc[df['year'] == 2005, 'generation (MWh)']) /
-                      df.loc[df['year'] == 2005,
-                             'generation (MWh)'].sum()).sum()
-
-        # Calculated index value in 2005 is 599.8484560355034
-        # If the value above is different throw an error
-        # if (index_2005 > 601) or (index_2005 < 599.5):
-        #     raise ValueError('Calculated 2005 index value', index_2005,
-        #                      'is outside expected range. Expected value is 599.848')
-        if type(index_2005) != float:
-            raise TypeError('index_2005 is', type(index_2005),
-                            'rather than a float.')
-
-        df['change since 2005'] = ((df['index (g/kWh)'] - index_2005) /
-                                   index_2005)
-
-    # ### Monthly Index
-    monthly_index = final_co2_gen.groupby(['year', 'month'])['generation (MWh)', 'final CO2 (kg)'].sum()
-    monthly_index.reset_index(inplace=True)
-    add_quarter(monthly_index)
-
-    monthly_index['index (g/kWh)'] = (monthly_index.loc[:, 'final CO2 (kg)'] /
-                                      monthly_index.loc[:, 'generation (MWh)'])
-
-    # change_since_2005(monthly_index)
-    g2lb(monthly_index)
-    monthly_index.dropna(inplace=True)
-
-    # ### Quarterly Index
-    # Built up from the monthly index
-    quarterly_index = monthly_index.groupby(['year', 'quarter'])['generation (MWh)', 'final CO2 (kg)'].sum()
-    quarterly_index.reset_index(inplace=True)
-    quarterly_index['index (g/kWh)'] = quarterly_index.loc[:, 'final CO2 (kg)'] / quarterly_index.loc[:, 'generation (MWh)']
-    quarterly_index['year_quarter'] = quarterly_index['year'].astype(str) + ' Q' + quarterly_index['quarter'].astype(str)
-    # change_since_2005(quarterly_index)
-    g2lb(quarterly_index)
-
-    # ### Annual Index
-    annual_index = quarterly_index.groupby('year')['generation (MWh)',
-                                                   'final CO2 (kg)'].sum()
-    annual_index.reset_index(inplace=True)
-
-    annual_index['index (g/kWh)'] = (annual_index.loc[:, 'final CO2 (kg)'] /
-                                     annual_index.loc[:, 'generation (MWh)'])
-    # change_since_2005(annual_index)
-    g2lb(annual_index)
+    # Monthly, quarterly, and annual index from a single rollup of the
+    # monthly facility data
+    rollup = index_rollup(final_co2_gen, calc_change_since_2005=False,
+                          gen_col='generation (MWh)', co2_col='final CO2 (kg)',
+                          index_col='index (g/kWh)', lb_col='index (lb/MWh)')
+    monthly_index = rollup['monthly']
+    quarterly_index = rollup['quarterly']
+    annual_index = rollup['annual']
 
     # Export index files
     if not os.path.isdir(export_folder):
@@ -347,18 +283,6 @@ def index_and_generation(eia_facility_df, all_fuel_path,
             state to NERC regions
         state: str with state or region of analysis
     """
-    # Create some helper functions to add datetime and quarter columns
-    def add_datetime(df, year='year', month='month'):
-        df['datetime'] = pd.to_datetime(df[year].astype(str) + '-' +
-                                        df[month].astype(str),
-                                        format='%Y-%m')
-
-    def add_quarter(df, year='year', month='month'):
-        add_datetime(df, year, month)
-        df['quarter'] = df['datetime'].dt.quarter
-
-
-
     # ### Facility generation and CO2 emissions
     eia_facility = eia_facility_df.copy()
     eia_facility['state'] = eia_facility.loc[:, 'geography'].str[-2:]
@@ -612,88 +536,26 @@ def index_and_generation(eia_facility_df, all_fuel_path,
 
     # ## Final index values
 
-    # Start with some helper functions to convert units and calculate % change
-    # from 2005 annual value
-
-    def g2lb(df):
-        """
-        Convert g/kWh to lb/MWh and add a column to the df
-        """
-        kg2lb = 2.2046
-        df['index (lb/MWh)'] = df['index (g/kWh)'] * kg2lb
-
-    def change_since_2005(df):
-        """
-        Calculate the % difference from 2005 and add as a column in the df
-        """
-        # first calculate the index in 2005
-        index_2005 = ((df.loc[df['year'] == 2005, 'index (g/kWh)'] *
-                       df.loc[df['year'] == 2005, 'generation (MWh)']) /
-                      df.loc[df['year'] == 2005,
-                             'generation (MWh)'].sum()).sum()
-
-        # Calculated index value in 2005 is 599.8484560355034
-        # If the value above is different throw an error
-        # if (index_2005 > 601) or (index_2005 < 599.5):
-        #     raise ValueError('Calculated 2005 index value', index_2005,
-        #                      'is outside expected range. Expected value is
-        # 599.848')
-        if type(index_2005) != float:
-            raise TypeError('index_2005 is', type(index_2005),
-                            'rather than a float.')
-
-        df['change since 2005'] = ((df['index (g/kWh)'] - index_2005) /
-                                   index_2005)
-
-
     # ### Monthly Index
     # Adding generation and emissions not captured in the facility-level data
 
-    monthly_index = final_co2_gen.groupby(['year', 'month'])['generation (MWh)', 'final CO2 (kg)'].sum()
-    monthly_index.reset_index(inplace=True)
+    monthly_co2_gen = (final_co2_gen.groupby(['year', 'month'])
+                                    [['generation (MWh)', 'final CO2 (kg)']]
+                                    .sum())
+    monthly_co2_gen.reset_index(inplace=True)
 
     # Add extra generation and emissions not captured by facility-level data
-    monthly_index.loc[:,'final CO2 (kg)'] += eia_extra.reset_index().groupby(['year', 'month'])['elec fuel CO2 (kg)'].sum().values
-    monthly_index.loc[:,'generation (MWh)'] += eia_extra.reset_index().groupby(['year', 'month'])['generation (MWh)'].sum().values
-    add_quarter(monthly_index)
-    monthly_index['index (g/kWh)'] = monthly_index.loc[:, 'final CO2 (kg)'] / monthly_index.loc[:, 'generation (MWh)']
-
-    change_since_2005(monthly_index)
-    g2lb(monthly_index)
-    monthly_index.dropna(inplace=True)
-
-    # if not os.path.isdir(export_folder):
-    #     os.mkdir(export_folder)
-    # path = join(export_folder, 'Monthly index'  + export_path_ext + '.csv')
-    # monthly_index.to_csv(path, index=False)
-
-
-    # ### Quarterly Index
-    # Built up from the monthly index
-
-    quarterly_index = monthly_index.groupby(['year', 'quarter'])['generation (MWh)', 'final CO2 (kg)'].sum()
-    quarterly_index.reset_index(inplace=True)
-    quarterly_index['index (g/kWh)'] = quarterly_index.loc[:, 'final CO2 (kg)'] / quarterly_index.loc[:, 'generation (MWh)']
-    quarterly_index['year_quarter'] = quarterly_index['year'].astype(str) + ' Q' + quarterly_index['quarter'].astype(str)
-    change_since_2005(quarterly_index)
-    g2lb(quarterly_index)
-
-
-    # path = join(export_folder, 'Quarterly index'  + export_path_ext + '.csv')
-    # quarterly_index.to_csv(path, index=False)
-
-
-    # ### Annual Index
-
-
-    annual_index = quarterly_index.groupby('year')['generation (MWh)', 'final CO2 (kg)'].sum()
-    annual_index.reset_index(inplace=True)
-
-    annual_index['index (g/kWh)'] = annual_index.loc[:, 'final CO2 (kg)'] / annual_index.loc[:, 'generation (MWh)']
-
-    change_since_2005(annual_index)
-    g2lb(annual_index)
-
+    monthly_co2_gen.loc[:,'final CO2 (kg)'] += eia_extra.reset_index().groupby(['year', 'month'])['elec fuel CO2 (kg)'].sum().values
+    monthly_co2_gen.loc[:,'generation (MWh)'] += eia_extra.reset_index().groupby(['year', 'month'])['generation (MWh)'].sum().values
+
+    # ### Monthly, quarterly, and annual index
+    # All three timeframes (and the change since 2005) come from one rollup
+    rollup = index_rollup(monthly_co2_gen,
+                          gen_col='generation (MWh)', co2_col='final CO2 (kg)',
+                          index_col='index (g/kWh)', lb_col='index (lb/MWh)')
+    monthly_index = rollup['monthly']
+    quarterly_index = rollup['quarterly']
+    annual_index = rollup['annual']
 
     # path = join(export_folder, 'Annual index'  + export_path_ext + '.csv')
     # annual_index.to_csv(path, index=False)
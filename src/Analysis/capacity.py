@@ -1,7 +1,10 @@
 import pandas as pd
+import numpy as np
 import os
 import calendar
 from joblib import Parallel, delayed
+from util.time_axis import (month_ordinal, month_ordinal_to_datetime,
+                            month_range, ordinal_year, ordinal_month)
 idx = pd.IndexSlice
 
 def month_hours(year, month):
@@ -14,6 +17,97 @@ def month_hours(year, month):
     return hours
 
 
+def reverse_cats(cat_file):
+    'Reverse a dict of lists so each item in the list is a key'
+    cat_map = {}
+    for key, vals in cat_file.items():
+        for val in vals:
+            cat_map[val] = key
+    return cat_map
+
+
+def valid_month(month):
+    'Months outside 1-12 (e.g. missing or 0 in 860m) are changed to 1'
+    month = pd.to_numeric(pd.Series(month), errors='coerce').values
+    return np.where((month > 12) | (month < 1), 1, month)
+
+
+def load_860m(path, state_cats=None, custom_cats=None, cache=True):
+    """
+    Load the Operating and Retired sheets of an EIA-860m generator workbook
+    in a single read, and add operating and retirement dates. Dates are
+    built from the year and month columns as integer month ordinals, and
+    converted to datetime columns ('op datetime' and 'ret datetime') for
+    monthly_capacity_all and monthly_ng_type_all. The typed result is
+    cached as feather files keyed by a hash of the workbook.
+
+    inputs:
+        path (str): path to the 860m Excel file
+        state_cats (dict): state-level fuel categories (e.g. from
+            State_facility.json). If given, add a 'fuel' column.
+        custom_cats (dict): custom fuel categories (e.g. from
+            Custom_results.json). If given with state_cats, add a
+            'fuel category' column.
+        cache (bool): load/save the typed sheets from the cache folder
+
+    outputs:
+        op (df): operating generators
+        ret (df): retired generators
+    """
+    from util.utils import file_hash, get_cache_path
+
+    key = file_hash(path)
+    op_path = get_cache_path('860m_{}_op.feather'.format(key))
+    ret_path = get_cache_path('860m_{}_ret.feather'.format(key))
+
+    if cache and os.path.exists(op_path) and os.path.exists(ret_path):
+        op = pd.read_feather(op_path)
+        ret = pd.read_feather(ret_path)
+
+    else:
+        sheets = pd.read_excel(path, sheet_name=['Operating', 'Retired'],
+                               skiprows=1, skipfooter=1, na_values=' ')
+        op = sheets['Operating']
+        ret = sheets['Retired']
+
+        for df in [op, ret]:
+            df.columns = df.columns.str.strip().str.lower()
+
+        op_cols = ['plant id', 'nameplate capacity (mw)',
+                   'net summer capacity (mw)', 'energy source code',
+                   'prime mover code', 'operating month', 'operating year']
+        ret_cols = op_cols + ['retirement month', 'retirement year']
+        op = op.loc[:, op_cols]
+        ret = ret.loc[:, ret_cols]
+
+        # Float ordinals so that missing dates can be NaN
+        for df in [op, ret]:
+            df['op ordinal'] = month_ordinal(
+                df['operating year'],
+                valid_month(df['operating month'])).astype(float)
+        ret['ret ordinal'] = month_ordinal(
+            ret['retirement year'],
+            valid_month(ret['retirement month'])).astype(float)
+
+        if cache:
+            op.to_feather(op_path)
+            ret.to_feather(ret_path)
+
+    # Convert month ordinals to datetime only for the capacity functions
+    for df, col in [(op, 'op'), (ret, 'op'), (ret, 'ret')]:
+        ordinal = df[col + ' ordinal']
+        dt = month_ordinal_to_datetime(ordinal.fillna(0).astype(np.int64))
+        df[col + ' datetime'] = pd.Series(dt).where(ordinal.notnull().values)
+
+    if state_cats:
+        for df in [op, ret]:
+            df['fuel'] = df['energy source code'].map(reverse_cats(state_cats))
+            if custom_cats:
+                df['fuel category'] = df['fuel'].map(reverse_cats(custom_cats))
+
+    return op, ret
+
+
 def monthly_capacity_all(op, ret, years, nerc_plant_list, fuels,
                          months=range(1,13), cap_type='nameplate capacity (mw)',
                          n_jobs=-1, print_year=False,):
@@ -89,9 +183,9 @@ def monthly_capacity_year(year, nerc_plants, op, ret, fuels,
     if print_year:
         print(year)
 
-    # create list of strings and convert to datetime
-    date_strings = ['{}-{}-01'.format(year, month) for month in months]
-    dt_list = pd.to_datetime(date_strings, yearfirst=True)
+    # datetime of the first day in each month
+    dt_list = pd.DatetimeIndex(month_ordinal_to_datetime(
+        month_range(year, year, months)))
 
     # Make an empty dataframe to fill with capacity and possible generation
     nercs = nerc_plants.keys()
@@ -248,9 +342,9 @@ def monthly_ng_type_year(year, nerc_plants, op, ret, fuels,
     if print_year:
         print(year)
 
-    # create list of strings and convert to datetime
-    date_strings = ['{}-{}-01'.format(year, month) for month in months]
-    dt_list = pd.to_datetime(date_strings, yearfirst=True)
+    # datetime of the first day in each month
+    dt_list = pd.DatetimeIndex(month_ordinal_to_datetime(
+        month_range(year, year, months)))
 
     # Make an empty dataframe to fill with capacity and possible generation
     nercs = nerc_plants.keys()
@@ -360,3 +454,153 @@ def ng_nerc_type(op, ret, plant_list, cap_type):
     total_cap = op_cap + ret_cap
 
     return total_cap
+
+
+def plant_capacity_array(op, ret, start_year, end_year,
+                         cap_type='nameplate capacity (mw)',
+                         group_col='fuel category'):
+    """
+    Dense array of active capacity for every plant/fuel category in every
+    month. Follows the same rules as monthly_capacity_year: generators are
+    not counted in the month that they come online or retire.
+
+    Capacity is added in the month after a generator comes online and
+    removed in the month it retires using a difference array, so all
+    generators are handled with array operations and a single cumulative sum.
+
+    inputs:
+        op (df): operating generators from load_860m
+        ret (df): retired generators from load_860m
+        start_year, end_year (int): range of years to calculate
+        cap_type (str): capacity column to use
+        group_col (str): column to split plant capacity by
+
+    outputs:
+        pairs (MultiIndex): (plant id, group_col) for each row of the array
+        ordinals (array): month ordinal (year * 12 + month - 1) for each column
+        capacity (array): active capacity, shape (len(pairs), len(ordinals))
+    """
+    cols = ['plant id', group_col, cap_type, 'op ordinal']
+    # Retired generators without a retirement date are not counted (the same
+    # as monthly_capacity_year)
+    ret = ret.dropna(subset=['ret ordinal'])
+    gens = pd.concat([op.loc[:, cols], ret.loc[:, cols + ['ret ordinal']]],
+                     ignore_index=True, sort=False)
+    gens = gens.dropna(subset=cols)
+
+    ordinals = month_range(start_year, end_year)
+    start, n_months = ordinals[0], len(ordinals)
+
+    codes, pairs = pd.MultiIndex.from_frame(
+        gens.loc[:, ['plant id', group_col]]).factorize()
+    pairs = pd.MultiIndex.from_tuples(pairs, names=['plant id', group_col])
+
+    first = np.clip(gens['op ordinal'].astype(np.int64).values + 1 - start,
+                    0, n_months)
+    # Operating generators are active through the end of the range
+    ret_ordinal = gens['ret ordinal'].fillna(start + n_months)
+    last = np.clip(ret_ordinal.values.astype(np.int64) - start, 0, n_months)
+    valid = first < last
+    capacity = gens[cap_type].values.astype(float)
+
+    diff = np.zeros((len(pairs), n_months + 1))
+    np.add.at(diff, (codes[valid], first[valid]), capacity[valid])
+    np.add.at(diff, (codes[valid], last[valid]), -capacity[valid])
+
+    return pairs, ordinals, np.cumsum(diff[:, :-1], axis=1)
+
+
+def capacity_factors(op, ret, gen_df, start_year, end_year, level='plant',
+                     labels=None, region_col='nerc',
+                     cap_type='nameplate capacity (mw)',
+                     gen_col='generation (mwh)', fuel_col='fuel category'):
+    """
+    Monthly capacity factors at the plant, region, or fuel level. Capacity
+    from 860m generators and generation from EIA facility data are aligned
+    on dense (plant/fuel, month) arrays.
+
+    inputs:
+        op (df): operating generators from load_860m (with fuel_col)
+        ret (df): retired generators from load_860m (with fuel_col)
+        gen_df (df): facility generation with 'plant id', 'year', 'month',
+            fuel_col, and gen_col columns (e.g. the gen/fuels output of
+            facility_emission_gen)
+        start_year, end_year (int): range of years to calculate
+        level (str): 'plant', 'region', or 'fuel'
+        labels (FacilityLabels, RegionMembership, or df): plant region
+            labels, required for level='region'. With a RegionMembership the
+            output has 'region type' and 'region' columns for every region
+            set instead of region_col.
+        region_col (str): name of the region label
+        cap_type (str): capacity column to use
+        gen_col (str): generation column in gen_df
+        fuel_col (str): fuel category column in both op/ret and gen_df
+
+    outputs:
+        df: 'active capacity', 'possible gen', gen_col, and 'capacity factor'
+            for each plant (or region) and fuel category by year and month
+    """
+    from util.utils import FacilityLabels
+    from Analysis.regions import RegionMembership
+
+    pairs, ordinals, capacity = plant_capacity_array(
+        op, ret, start_year, end_year, cap_type=cap_type, group_col=fuel_col)
+
+    # Rows with a missing plant id, fuel category, or month aren't counted
+    gen = gen_df.loc[(gen_df['year'] >= start_year)
+                     & (gen_df['year'] <= end_year)]
+    gen = gen.dropna(subset=['plant id', fuel_col, 'month'])
+    gen_pairs = pd.MultiIndex.from_frame(gen.loc[:, ['plant id', fuel_col]])
+
+    # Add plant/fuel pairs with generation but no capacity
+    pairs = pairs.append(gen_pairs.unique().difference(pairs))
+    capacity = np.vstack([capacity,
+                          np.zeros((len(pairs) - len(capacity),
+                                    len(ordinals)))])
+
+    # get_indexer gives -1 for any row without a pair, which np.add.at
+    # would add to the last pair
+    generation = np.zeros_like(capacity)
+    rows = pairs.get_indexer(gen_pairs)
+    matched = rows >= 0
+    cols = month_ordinal(gen['year'].values, gen['month'].values) - ordinals[0]
+    np.add.at(generation, (rows[matched], cols[matched]),
+              np.nan_to_num(gen[gen_col].values[matched].astype(float)))
+
+    hours = pd.DatetimeIndex(month_ordinal_to_datetime(ordinals)).days_in_month
+    possible = capacity * (hours.values * 24)
+
+    # Tidy output for cells with capacity or generation
+    row, col = np.nonzero((capacity > 0) | (generation != 0))
+    df = pd.DataFrame({'plant id': pairs.get_level_values(0)[row],
+                       fuel_col: pairs.get_level_values(1)[row],
+                       'year': ordinal_year(ordinals[col]),
+                       'month': ordinal_month(ordinals[col]),
+                       'active capacity': capacity[row, col],
+                       'possible gen': possible[row, col],
+                       gen_col: generation[row, col]})
+
+    sum_cols = ['active capacity', 'possible gen', gen_col]
+    if level == 'region' and isinstance(labels, RegionMembership):
+        df = labels.aggregate(df, sum_cols, keys=[fuel_col, 'year', 'month'])
+        group_cols = None
+    elif level == 'region':
+        if not isinstance(labels, FacilityLabels):
+            labels = FacilityLabels(labels)
+        df[region_col] = labels.get(region_col, df['plant id'].values,
+                                    df['year'].values)
+        group_cols = [region_col, fuel_col, 'year', 'month']
+    elif level == 'fuel':
+        group_cols = [fuel_col, 'year', 'month']
+    else:
+        group_cols = None
+
+    if group_cols:
+        df = (df.groupby(group_cols)[sum_cols]
+                .sum()
+                .reset_index())
+
+    df['capacity factor'] = (df[gen_col]
+                             / df['possible gen'].where(df['possible gen'] > 0))
+
+    return df
@@ -0,0 +1,153 @@
+# coding: utf-8
+
+from collections import OrderedDict
+import pandas as pd
+import numpy as np
+
+
+class LabeledCube(object):
+    """
+    A dense numpy array with labeled axes (e.g. type x year x month, or
+    region x type x year x month) and a trailing axis of measures (e.g.
+    generation, total fuel, elec fuel). Arithmetic between cubes is done on
+    the whole array at once after aligning labels, rather than on a
+    MultiIndex dataframe.
+
+    A boolean mask records which cells had data in the source frame, so that
+    converting back to a tidy frame only returns cells that would have
+    existed in the equivalent pandas operation.
+
+    inputs:
+        values (array): shape (len(axis_1), ..., len(axis_n), len(measures))
+        axes (OrderedDict): axis name -> pd.Index of labels
+        measures (list): names of the measures on the last axis
+        mask (array): boolean array with the shape of the labeled axes
+    """
+
+    def __init__(self, values, axes, measures, mask=None):
+        self.values = values
+        self.axes = OrderedDict((name, pd.Index(labels))
+                                for name, labels in axes.items())
+        self.measures = list(measures)
+        if mask is None:
+            mask = np.ones(self.shape, dtype=bool)
+        self.mask = mask
+
+    @property
+    def shape(self):
+        'Shape of the labeled axes (without the measure axis)'
+        return tuple(len(labels) for labels in self.axes.values())
+
+    @classmethod
+    def from_frame(cls, df, axes, measures, labels=None, fill_value=0):
+        """
+        Build a cube from a tidy (or MultiIndex) dataframe. Rows with the same
+        labels are summed, and missing values are treated as 0 (the same as a
+        pandas groupby sum).
+
+        inputs:
+            df (df): dataframe with the axes as columns or index levels
+            axes (list): column names to use as axes
+            measures (list): columns to use as measures
+            labels (dict): optional axis name -> labels. Rows with labels that
+                aren't in the list are dropped. Defaults to the sorted unique
+                values in df.
+            fill_value: value for cells that don't have data
+        """
+        if any(name in (df.index.names or []) for name in axes):
+            df = df.reset_index()
+        labels = labels or {}
+
+        axis_labels = OrderedDict()
+        codes = []
+        for name in axes:
+            if name in labels:
+                axis_labels[name] = pd.Index(labels[name])
+                codes.append(axis_labels[name].get_indexer(df[name]))
+            else:
+                code, uniques = pd.factorize(df[name], sort=True)
+                axis_labels[name] = pd.Index(uniques)
+                codes.append(code)
+
+        shape = tuple(len(x) for x in axis_labels.values())
+        keep = np.all([c >= 0 for c in codes], axis=0)
+        codes = [c[keep] for c in codes]
+        size = int(np.prod(shape))
+        flat = np.ravel_multi_index(codes, shape) if size else codes[0]
+
+        values = np.empty((size, len(measures)))
+        for i, measure in enumerate(measures):
+            weights = np.nan_to_num(df[measure].values[keep].astype(float))
+            values[:, i] = np.bincount(flat, weights=weights, minlength=size)
+
+        mask = np.bincount(flat, minlength=size) > 0
+        values[~mask] = fill_value
+
+        return cls(values.reshape(shape + (len(measures),)), axis_labels,
+                   measures, mask.reshape(shape))
+
+    def positions(self, axis, labels):
+        'Integer positions of labels on an axis. Missing labels are dropped.'
+        pos = self.axes[axis].get_indexer(labels)
+        return pos[pos >= 0]
+
+    def measure(self, name):
+        'Return the array for a single measure (shape of the labeled axes)'
+        return self.values[..., self.measures.index(name)]
+
+    def reindex(self, fill_value=0, **labels):
+        """
+        Return a new cube with new labels on one or more axes. Cells for new
+        labels are filled with fill_value and are not in the mask.
+        """
+        values, mask = self.values, self.mask
+        axes = OrderedDict(self.axes)
+        for i, (name, old) in enumerate(self.axes.items()):
+            if name not in labels:
+                continue
+            new = pd.Index(labels[name])
+            indexer = old.get_indexer(new)
+            missing = indexer < 0
+            values = np.take(values, np.maximum(indexer, 0), axis=i)
+            mask = np.take(mask, np.maximum(indexer, 0), axis=i)
+            if missing.any():
+                sl = [slice(None)] * mask.ndim
+                sl[i] = missing
+                values[tuple(sl)] = fill_value
+                mask[tuple(sl)] = False
+            axes[name] = new
+
+        return LabeledCube(values, axes, self.measures, mask)
+
+    def align(self, other):
+        'Reindex both cubes to the sorted union of their labels on each axis'
+        labels = {name: self.axes[name].union(other.axes[name])
+                  for name in self.axes}
+
+        return self.reindex(**labels), other.reindex(**labels)
+
+    def __sub__(self, other):
+        left, right = self.align(other)
+        return LabeledCube(left.values - right.values, left.axes,
+                           left.measures, left.mask | right.mask)
+
+    def __add__(self, other):
+        left, right = self.align(other)
+        return LabeledCube(left.values + right.values, left.axes,
+                           left.measures, left.mask | right.mask)
+
+    def to_frame(self, measures=None):
+        """
+        Convert the cube back to a dataframe with a MultiIndex of the axes
+        and a column for each measure. Only cells in the mask are included.
+        """
+        measures = measures or self.measures
+        cols = [self.measures.index(m) for m in measures]
+
+        flat_mask = self.mask.ravel()
+        index = pd.MultiIndex.from_product(list(self.axes.values()),
+                                           names=list(self.axes.keys()))
+        values = self.values.reshape(-1, len(self.measures))
+
+        return pd.DataFrame(values[flat_mask][:, cols],
+                            index=index[flat_mask], columns=measures)
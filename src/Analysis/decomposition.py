@@ -0,0 +1,148 @@
+# coding: utf-8
+
+import pandas as pd
+import numpy as np
+from Analysis.cube import LabeledCube
+
+# Small value used in place of zero shares and intensities (Ang and Liu,
+# 2007). Effects converge to the limit as this goes to zero.
+SMALL_VALUE = 1e-20
+
+
+def log_mean(a, b):
+    """
+    Logarithmic mean of two arrays. L(a, a) = a, and L(a, b) = 0 if either
+    value is 0.
+    """
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float),
+                               np.asarray(b, dtype=float))
+    out = np.where(a == b, a, 0.0)
+    diff = (a != b) & (a > 0) & (b > 0)
+    out[diff] = (a[diff] - b[diff]) / (np.log(a[diff]) - np.log(b[diff]))
+
+    return out
+
+
+def period_pairs(periods, base=None):
+    """
+    (start, end) pairs of periods. Each period is compared to base if one is
+    given, otherwise to the period before it.
+    """
+    periods = sorted(periods)
+    if base is not None:
+        return [(base, period) for period in periods if period != base]
+
+    return list(zip(periods[:-1], periods[1:]))
+
+
+def lmdi_decomposition(fuel_df, pairs=None, base=None,
+                       region_cols=('region type', 'region'),
+                       period_col='year', fuel_col='fuel category',
+                       gen_col='generation (mwh)',
+                       co2_col='adjusted co2 (kg)'):
+    """
+    Additive log-mean Divisia (LMDI-I) decomposition of the change in
+    emissions intensity between two periods into a generation mix effect
+    and a fuel intensity effect for every fuel. All regions, fuels, and
+    period pairs are calculated at once on a region x fuel x period cube.
+
+    The intensity of a region is the sum over fuels of share * fuel
+    intensity. For each fuel:
+        mix effect = L(I_end, I_start) * ln(share_end / share_start)
+        intensity effect = L(I_end, I_start) * ln(int_end / int_start)
+    where I = share * fuel intensity and L is the logarithmic mean. The
+    effects add up to the change in intensity with no residual. Zero
+    shares and intensities are replaced with a small value, and a fuel
+    without generation in one period uses its intensity from the other
+    period (so all of its change is a mix effect).
+
+    inputs:
+        fuel_df (df): generation and co2 for each region, fuel, and period
+            (e.g. the 'annual' output of region_generation_index)
+        pairs (list): (start, end) periods to compare. Defaults to
+            period_pairs(periods, base).
+        base: compare every period to this one (e.g. 2005) if pairs isn't
+            given
+        region_cols (list): columns that identify a region
+        period_col (str): column with the period (e.g. 'year')
+        fuel_col, gen_col, co2_col (str): column names
+
+    outputs:
+        fuel_effects (df): region_cols, fuel_col, 'start', 'end', and the
+            'mix effect (g/kwh)', 'intensity effect (g/kwh)', and
+            'total effect (g/kwh)' of each fuel
+        region_effects (df): region_cols, 'start', 'end', the index in each
+            period, the change, and the summed effects
+    """
+    region_cols = list(region_cols)
+
+    # One integer code for each region so the cube only has a region axis
+    region_codes, regions = pd.factorize(
+        pd.MultiIndex.from_frame(fuel_df.loc[:, region_cols]), sort=True)
+    df = fuel_df.loc[:, [fuel_col, period_col, gen_col, co2_col]].copy()
+    df['region code'] = region_codes
+
+    cube = LabeledCube.from_frame(df, ['region code', fuel_col, period_col],
+                                  [gen_col, co2_col])
+    periods = cube.axes[period_col]
+    if pairs is None:
+        pairs = period_pairs(periods, base)
+    pairs = list(pairs)
+    start = periods.get_indexer([p[0] for p in pairs])
+    end = periods.get_indexer([p[1] for p in pairs])
+    if (start < 0).any() or (end < 0).any():
+        raise KeyError('Periods in pairs are missing from fuel_df')
+
+    # region x fuel x period arrays
+    gen = np.maximum(cube.measure(gen_col), 0)
+    co2 = np.maximum(cube.measure(co2_col), 0)
+    total_gen = gen.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = gen / total_gen
+        intensity = co2 / gen
+        index = co2.sum(axis=1) / total_gen[:, 0]
+
+    # region x fuel x pair arrays for the start and end of each pair
+    s0, s1 = share[:, :, start], share[:, :, end]
+    i0, i1 = intensity[:, :, start], intensity[:, :, end]
+    i0 = np.where(np.isnan(i0), i1, i0)
+    i1 = np.where(np.isnan(i1), i0, i1)
+    s0, s1, i0, i1 = [np.maximum(np.nan_to_num(x), SMALL_VALUE)
+                      for x in (s0, s1, i0, i1)]
+
+    weight = log_mean(s1 * i1, s0 * i0)
+    mix = weight * np.log(s1 / s0)
+    fuel_int = weight * np.log(i1 / i0)
+
+    # Only keep regions with generation in both periods, and fuels with
+    # generation in either period
+    region_ok = (total_gen[:, 0, start] > 0) & (total_gen[:, 0, end] > 0)
+    fuel_ok = (gen[:, :, start] > 0) | (gen[:, :, end] > 0)
+    keep = region_ok[:, None, :] & fuel_ok
+
+    r, p, f = np.nonzero(keep.transpose(0, 2, 1))
+    fuel_effects = pd.DataFrame(
+        {col: regions.get_level_values(i)[r]
+         for i, col in enumerate(region_cols)})
+    fuel_effects[fuel_col] = cube.axes[fuel_col][f]
+    fuel_effects['start'] = periods[start[p]]
+    fuel_effects['end'] = periods[end[p]]
+    fuel_effects['mix effect (g/kwh)'] = mix[r, f, p]
+    fuel_effects['intensity effect (g/kwh)'] = fuel_int[r, f, p]
+    fuel_effects['total effect (g/kwh)'] = (mix[r, f, p]
+                                            + fuel_int[r, f, p])
+
+    r, p = np.nonzero(region_ok)
+    region_effects = pd.DataFrame(
+        {col: regions.get_level_values(i)[r]
+         for i, col in enumerate(region_cols)})
+    region_effects['start'] = periods[start[p]]
+    region_effects['end'] = periods[end[p]]
+    region_effects['start index (g/kwh)'] = index[r, start[p]]
+    region_effects['end index (g/kwh)'] = index[r, end[p]]
+    region_effects['change (g/kwh)'] = (index[r, end[p]]
+                                        - index[r, start[p]])
+    region_effects['mix effect (g/kwh)'] = mix.sum(axis=1)[r, p]
+    region_effects['intensity effect (g/kwh)'] = fuel_int.sum(axis=1)[r, p]
+
+    return fuel_effects, region_effects
@@ -0,0 +1,223 @@
+# coding: utf-8
+
+import os
+from os.path import join
+import pandas as pd
+import numpy as np
+from util.utils import FacilityLabels
+from util.time_axis import (date_hour_to_datetime, datetime_to_month_ordinal,
+                            month_ordinal)
+from Data.data_extraction import unit_conversion
+
+CEMS_COLS = ['ORISPL_CODE', 'OP_DATE_TIME', 'OP_DATE', 'OP_HOUR', 'OP_TIME',
+             'GLOAD (MW)', 'CO2_MASS (tons)']
+
+
+def cems_datetime(chunk, freq='hourly'):
+    """
+    Operating datetime of each CEMS row, from either an OP_DATE_TIME column
+    (files saved by import_clean_epa) or the raw OP_DATE (mm-dd-yyyy) and
+    OP_HOUR columns. Daily values are floored to the day.
+    """
+    if 'OP_DATE_TIME' in chunk.columns:
+        dt = pd.to_datetime(chunk['OP_DATE_TIME']).values
+    else:
+        dt = date_hour_to_datetime(chunk['OP_DATE'], chunk['OP_HOUR'])
+
+    if freq == 'daily':
+        dt = dt.astype('datetime64[D]')
+
+    return dt.astype('datetime64[ns]')
+
+
+def ratio_lookup(eia_grouped):
+    """
+    Sorted (plant id, month) keys and co2 ratios from group_facility_data,
+    used to find the ratio for each CEMS row with a binary search.
+    """
+    ordinal = month_ordinal(eia_grouped['year'].values,
+                            eia_grouped['month'].values).astype(np.int64)
+    keys = (eia_grouped['plant id'].values.astype(np.int64) * 10**6
+            + ordinal)
+    order = np.argsort(keys)
+
+    return keys[order], eia_grouped['co2 ratio'].fillna(0).values[order]
+
+
+def cems_chunk_totals(chunk, ratio_keys, ratios, labels, region_col='nerc',
+                      freq='hourly'):
+    """
+    Adjusted co2 and generation for each region and hour (or day) in a chunk
+    of CEMS rows. CO2 is scaled by the plant-month co2 ratio, and rows from
+    plant-months without EIA data are dropped (the same as the inner merge
+    in adjust_epa_emissions). Plants without a region label are in an
+    'unlabeled' region.
+
+    outputs:
+        df: region_col, 'datetime', 'generation (mwh)', and 'adj co2 (kg)'
+    """
+    dt = cems_datetime(chunk, freq)
+    months = datetime_to_month_ordinal(dt).astype(np.int64)
+    plant = chunk['ORISPL_CODE'].values.astype(np.int64)
+
+    key = plant * 10**6 + months
+    pos = np.searchsorted(ratio_keys, key)
+    found = pos < len(ratio_keys)
+    found[found] = ratio_keys[pos[found]] == key[found]
+
+    gen = np.nan_to_num(chunk['GLOAD (MW)'].values.astype(float)
+                        * chunk['OP_TIME'].values.astype(float))
+    co2 = unit_conversion(np.nan_to_num(
+        chunk['CO2_MASS (tons)'].values.astype(float)), 'tons', 'kg')
+
+    # Plants without a label are kept in an 'unlabeled' region so they are
+    # still counted in the national total
+    region = pd.Series(labels.get(region_col, plant[found],
+                                  months[found] // 12)).fillna('unlabeled')
+    df = pd.DataFrame({region_col: region.values,
+                       'datetime': dt[found],
+                       'generation (mwh)': gen[found],
+                       'adj co2 (kg)': co2[found] * ratios[pos[found]]})
+
+    return (df.groupby([region_col, 'datetime'])
+              [['generation (mwh)', 'adj co2 (kg)']]
+              .sum()
+              .reset_index())
+
+
+def cems_file_year(path, col_name_map=None):
+    'Year of the first row in a CEMS file (None if the file has no rows)'
+    chunk = pd.read_csv(path, usecols=lambda col: (col_name_map or {})
+                        .get(col, col) in CEMS_COLS, nrows=1)
+    if chunk.empty:
+        return None
+    chunk = chunk.rename(columns=col_name_map or {})
+
+    return int(pd.DatetimeIndex(cems_datetime(chunk)).year[0])
+
+
+def hourly_intensity(paths, eia_grouped, labels, output_folder,
+                     region_col='nerc', freq='hourly', chunksize=10**6,
+                     combine_every=10, col_name_map=None, national=True):
+    """
+    Hourly (or daily) carbon intensity of generation reported to CEMS in each
+    region. CEMS files are streamed in chunks of rows, so memory use depends
+    on chunksize and the number of region-hours rather than the size of the
+    files. Each chunk is reduced to region-hour totals right away, and the
+    totals are combined after every combine_every chunks.
+
+    Files are processed in order of year (from the first row of each file),
+    and the output for a year is written as soon as all files for that year
+    are done. Each file should only have data from one year.
+
+    CO2 emissions are scaled by the monthly co2 ratio of each plant (from
+    group_facility_data) to remove CHP and biomass emissions. The monthly
+    replacement of zero/low-index EPA records with EIA values can't be done
+    at an hourly resolution, so hourly totals won't exactly match the
+    monthly index. Plants without a region label are in an 'unlabeled'
+    region, and are included in the national total.
+
+    inputs:
+        paths (list): CEMS csv files (or zipped csv files). Files can be raw
+            EPA downloads or the yearly files made with import_clean_epa.
+        eia_grouped (df): output of group_facility_data with 'plant id',
+            'year', 'month', and 'co2 ratio'
+        labels (df or FacilityLabels): facility labels with region_col
+        output_folder (str): folder for the output files. One feather file is
+            written for each year.
+        region_col (str): region label to aggregate to
+        freq (str): 'hourly' or 'daily'
+        chunksize (int): number of CEMS rows to read at a time
+        combine_every (int): number of chunk totals to keep before they are
+            combined with the running totals
+        col_name_map (dict): rename raw CEMS columns (see import_clean_epa)
+        national (bool): add a 'USA' region with the total of all plants
+
+    outputs:
+        list: paths of the files that were written
+    """
+    if not isinstance(labels, FacilityLabels):
+        labels = FacilityLabels(labels)
+    ratio_keys, ratios = ratio_lookup(eia_grouped)
+    col_name_map = col_name_map or {}
+
+    def usecols(col):
+        return col_name_map.get(col, col) in CEMS_COLS
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    def write_year(year, df):
+        if national:
+            usa = (df.groupby('datetime')[['generation (mwh)',
+                                           'adj co2 (kg)']]
+                     .sum()
+                     .reset_index())
+            usa[region_col] = 'USA'
+            df = pd.concat([df, usa], ignore_index=True, sort=False)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df['index (g/kwh)'] = df['adj co2 (kg)'] / df['generation (mwh)']
+
+        path = join(output_folder,
+                    '{} {} intensity {}.feather'.format(region_col, freq,
+                                                        year))
+        (df.sort_values([region_col, 'datetime'])
+           .reset_index(drop=True)
+           .to_feather(path))
+        return path
+
+    def combine(partials):
+        'Sum a list of region-hour totals'
+        return (pd.concat(partials)
+                  .groupby([region_col, 'datetime'])
+                  .sum()
+                  .reset_index())
+
+    # Files without any rows are skipped
+    file_years = pd.Series([cems_file_year(path, col_name_map)
+                            for path in paths], dtype=object)
+    paths = np.asarray(paths)[file_years.notnull().values]
+    file_years = file_years.dropna().astype(int)
+
+    out_paths = []
+    written = set()
+    totals = None
+    for file_year in sorted(file_years.unique()):
+        for path in paths[(file_years == file_year).values]:
+            reader = pd.read_csv(path, usecols=usecols, chunksize=chunksize,
+                                 low_memory=False)
+            partials = [] if totals is None else [totals]
+            for chunk in reader:
+                partials.append(cems_chunk_totals(
+                    chunk.rename(columns=col_name_map), ratio_keys, ratios,
+                    labels, region_col, freq))
+                # Fold chunk totals into the running totals so memory use
+                # doesn't grow with the size of the file
+                if len(partials) > combine_every:
+                    partials = [combine(partials)]
+            if partials:
+                totals = combine(partials)
+
+        if totals is None:
+            continue
+
+        # Write every year that is done, and keep any later years
+        years = totals['datetime'].dt.year
+        if written.intersection(years.unique()):
+            raise ValueError('Data for a year that was already written '
+                             'were found in files for {}'.format(file_year))
+        for year in sorted(years.unique()):
+            if year <= file_year:
+                out_paths.append(write_year(
+                    year, totals.loc[years == year].reset_index(drop=True)))
+                written.add(year)
+        totals = totals.loc[years > file_year]
+
+    if totals is not None and len(totals):
+        years = totals['datetime'].dt.year
+        for year in sorted(years.unique()):
+            out_paths.append(write_year(
+                year, totals.loc[years == year].reset_index(drop=True)))
+
+    return out_paths
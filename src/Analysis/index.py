@@ -6,25 +6,32 @@ import os
 from os.path import join, abspath, normpath, dirname, split
 import numpy as np
 from util.utils import getParentDir, rename_cols
+from util.time_axis import (month_ordinal, month_ordinal_to_datetime,
+                            datetime_to_month_ordinal, ordinal_quarter)
+from Analysis.cube import LabeledCube
 import json
 
-def add_datetime(df, year='year', month='month'):
+def _year_month(df, year='year', month='month'):
+    'Year and month arrays from columns or MultiIndex levels'
     if type(df.index) is not pd.MultiIndex:
-        df['datetime'] = pd.to_datetime(df[year].astype(str) + '-' +
-                                        df[month].astype(str),
-                                        format='%Y-%m')
+        return df[year].values, df[month].values
     elif 'year' in df.index.names and 'month' in df.index.names:
-        year = df.index.get_level_values('year').astype(str)
-        month = df.index.get_level_values('month').astype(str)
-        df['datetime'] = pd.to_datetime(year + '-' + month, format='%Y-%m')
-
+        return (df.index.get_level_values('year').values,
+                df.index.get_level_values('month').values)
     else:
         raise IndexError('MultiIndex without year and month levels')
 
+def add_datetime(df, year='year', month='month'):
+    'Add a datetime column from year and month (columns or index levels)'
+    ordinal = month_ordinal(*_year_month(df, year, month))
+    df['datetime'] = month_ordinal_to_datetime(ordinal)
+
 def add_quarter(df, year='year', month='month'):
+    'Add datetime (if missing) and quarter columns'
     if 'datetime' not in df.columns:
         add_datetime(df, year, month)
-    df['quarter'] = df['datetime'].dt.quarter
+    df['quarter'] = ordinal_quarter(
+        datetime_to_month_ordinal(df['datetime'].values))
 
 
 def facility_emission_gen(eia_facility, epa, state_fuel_cat,
@@ -52,26 +59,20 @@ def facility_emission_gen(eia_facility, epa, state_fuel_cat,
         co2: total adjusted co2 emissions
         gen_fuels: generation and fuel consumption
     """
-    # Make column names consistent
+    # Make column names consistent (without changing the input dataframes)
     if print_status:
         print('Renaming columns')
-    rename_cols(eia_facility)
-    rename_cols(epa)
+    eia_facility = rename_cols(eia_facility, inplace=False)
+    epa = rename_cols(epa, inplace=False)
     if print_status:
         print('Grouping facilities')
     eia_grouped = group_facility_data(eia_facility)
 
+    # Adjust EPA emissions and calculate final co2 in a single pass (the same
+    # results as adjust_epa_emissions followed by facility_co2)
     if print_status:
-        print('Adjusting EPA emissions')
-    epa_adj = adjust_epa_emissions(epa, eia_grouped)
-
-    # I need to return co2 (by facility, or just per month?) and gen/fuels by
-    # fuel type.
-
-    if print_status:
-        print('Caculating CO2')
-    co2 = facility_co2(epa_adj, eia_grouped)
-    co2 = co2.loc[:, ['year', 'month', 'plant id', 'final co2 (kg)']]
+        print('Adjusting EPA emissions and calculating CO2')
+    co2 = facility_final_co2(eia_grouped, epa)
 
     if print_status:
         print('Gen/fuels to state categories')
@@ -106,7 +107,7 @@ def group_facility_data(eia):
     grouped_df.reset_index(inplace=True)
     grouped_df['co2 ratio'] = (grouped_df['elec fuel fossil co2 (kg)']
                                / grouped_df['all fuel total co2 (kg)'])
-    grouped_df['co2 ratio'].fillna(0, inplace=True)
+    grouped_df['co2 ratio'] = grouped_df['co2 ratio'].fillna(0)
 
     return grouped_df
 
@@ -185,6 +186,76 @@ def facility_co2(epa_adj, eia_facility):
 
     return df
 
+def facility_final_co2(eia_grouped, epa):
+    """
+    Adjust EPA emissions and calculate final co2 for each facility-month in
+    one pass. Gives the same result as adjust_epa_emissions followed by
+    facility_co2, but both dataframes are aligned by sorting on
+    (plant id, year, month) keys once instead of with two merges.
+
+    inputs:
+        eia_grouped (df): output of group_facility_data
+        epa (df): monthly EPA facility data with 'plant id', 'year', 'month',
+            'co2_mass (kg)', 'gload (mw)', and 'heat_input (mmbtu)'
+
+    outputs:
+        df: 'year', 'month', 'plant id', and 'final co2 (kg)'
+    """
+    def month_key(df):
+        'Single int64 key for (year, month, plant id)'
+        ordinal = month_ordinal(df['year'].values, df['month'].values)
+        return (ordinal.astype(np.int64) * 10**7
+                + df['plant id'].values.astype(np.int64))
+
+    # Without EPA data the final co2 is the calculated EIA value
+    if len(epa) == 0:
+        df = eia_grouped.loc[:, ['year', 'month', 'plant id']]
+        df = df.reset_index(drop=True)
+        df['final co2 (kg)'] = (eia_grouped['elec fuel fossil co2 (kg)']
+                                .values.astype(float))
+        return df
+
+    # EPA rows for each EIA row. A stable sort keeps duplicate EPA rows in
+    # their original order (the same as a left merge).
+    eia_key = month_key(eia_grouped)
+    epa_key = month_key(epa)
+    order = np.argsort(epa_key, kind='mergesort')
+    first = np.searchsorted(epa_key[order], eia_key, side='left')
+    counts = np.searchsorted(epa_key[order], eia_key, side='right') - first
+
+    n_rows = np.maximum(counts, 1)
+    eia_rows = np.repeat(np.arange(len(eia_grouped)), n_rows)
+    offset = np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows,
+                                                 n_rows)
+    matched = counts[eia_rows] > 0
+    epa_rows = order[np.minimum(first[eia_rows] + offset, len(order) - 1)]
+
+    def epa_values(col):
+        values = epa[col].values.astype(float)[epa_rows]
+        return np.where(matched, values, np.nan)
+
+    co2_mass = epa_values('co2_mass (kg)')
+    heat = epa_values('heat_input (mmbtu)')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        epa_index = co2_mass / epa_values('gload (mw)')
+    all_total = eia_grouped['all fuel total co2 (kg)'].values[eia_rows]
+    ratio = eia_grouped['co2 ratio'].values[eia_rows]
+
+    # Same rules as adjust_epa_emissions
+    replace = (((~(co2_mass > 0)) | (epa_index < 300))
+               & (heat > 0) & (all_total > 0))
+    adj = np.where(replace, np.nan, co2_mass)
+    adj = np.where(np.isnan(ratio), adj, adj * ratio)
+
+    elec_fossil = eia_grouped['elec fuel fossil co2 (kg)'].values[eia_rows]
+    final = np.where(np.isnan(adj), elec_fossil, adj)
+
+    df = eia_grouped.loc[:, ['year', 'month', 'plant id']].iloc[eia_rows]
+    df = df.reset_index(drop=True)
+    df['final co2 (kg)'] = final
+
+    return df
+
 def group_fuel_cats(df, fuel_cats, fuel_col='fuel', new_col='type',
                     extra_group_cols=[]):
     """
@@ -208,7 +279,7 @@ def group_fuel_cats(df, fuel_cats, fuel_col='fuel', new_col='type',
 
     return df_grouped
 
-def extra_emissions_gen(facility_gen_fuels, eia_total, ef):
+def extra_emissions_gen(facility_gen_fuels, eia_total, ef, region_col=None):
     """
     Augment facility data with EIA estimates of non-reporting facilities. This
     information is only available at the state level.
@@ -219,6 +290,9 @@ def extra_emissions_gen(facility_gen_fuels, eia_total, ef):
         eia_total: (dataframe) total generation and fuel consumption from all
             facilities (including non-reporting), by state
         ef: (dataframe) emission factors for fuel consumption
+        region_col (str): optional column (e.g. 'nerc') in both dataframes.
+            If given, extra generation and emissions are calculated for each
+            region.
 
     output:
         state_gen_fuels: generation and fuel consumption from non-reporting
@@ -232,73 +306,56 @@ def extra_emissions_gen(facility_gen_fuels, eia_total, ef):
     # facilities are the same as those in the eia total data.
     assert 'type' in facility_gen_fuels.columns
     assert 'type' in eia_total.columns
-    facility_fuel_cats = facility_gen_fuels['type'].unique()
     total_fuel_cats = eia_total['type'].unique()
-    # for fuel in facility_fuel_cats:
-    #     assert fuel in total_fuel_cats
 
     # Only keep unique fuel codes - e.g. total solar includes SUN and DPV
     keep_types = [u'WWW', u'WND', u'WAS', u'SUN', 'DPV', u'NUC', u'NG',
        u'PEL', u'PC', u'OTH', u'COW', u'OOG', u'HPS', u'HYC', u'GEO']
-    keep_cols = ['generation (mwh)', 'total fuel (mmbtu)', 'elec fuel (mmbtu)',
-                 'all fuel co2 (kg)', 'elec fuel co2 (kg)']
-    eia_total_monthly = (eia_total.loc[(eia_total['type'].isin(keep_types))]
-                         .groupby(['type', 'year', 'month'])[keep_cols]
-                         .sum())
-
-    # Set up a MultiIndex. Useful when subtracting facility from total data
-    years = facility_gen_fuels.year.unique()
-    months = facility_gen_fuels.month.unique()
-    iterables = [total_fuel_cats, years, months]
-    index = pd.MultiIndex.from_product(iterables=iterables,
-                                   names=['type', 'year', 'month'])
-
-    # eia_extra will be the difference between total and facility
-    eia_extra = pd.DataFrame(index=index, columns=['total fuel (mmbtu)',
-                                                   'generation (mwh)',
-                                                   'elec fuel (mmbtu)'])
-    # give gen_fuels a MultiIndex
-    gen_fuels = facility_gen_fuels.groupby(['type', 'year', 'month']).sum()
-
-    # will need the IndexSlice to reference into the MultiIndex
-    idx = pd.IndexSlice
-
-    # Need to use .subtract() here because of NaN values
-    use_columns=['total fuel (mmbtu)', 'generation (mwh)', 'elec fuel (mmbtu)']
-    eia_extra = (eia_total_monthly.loc[:, use_columns]
-                 .subtract(gen_fuels.loc[:, use_columns], fill_value=0))
+    use_columns = ['total fuel (mmbtu)', 'generation (mwh)',
+                   'elec fuel (mmbtu)']
+    axes = ['type', 'year', 'month']
+    if region_col:
+        axes = [region_col] + axes
+
+    # Dense (region x) type x year x month cubes of total and facility data.
+    # Subtracting aligned cubes is the same as .subtract(fill_value=0) on
+    # the grouped dataframes.
+    eia_total_monthly = LabeledCube.from_frame(
+        eia_total.loc[eia_total['type'].isin(keep_types)], axes, use_columns)
+    gen_fuels = LabeledCube.from_frame(facility_gen_fuels, axes, use_columns)
+    eia_total_monthly, gen_fuels = eia_total_monthly.align(gen_fuels)
+    eia_extra = eia_total_monthly - gen_fuels
 
     # I have lumped hydro pumped storage in with conventional hydro in the
     # facility data. Because of this, I need to add HPS rows so that the totals
     # will add up correctly. Also need to add DPV because it won't show up
     # otherwise (not in both dataframes)
-    eia_extra.loc[idx[['HPS', 'DPV'],:,:],
-                  use_columns] = (eia_total_monthly
-                                  .loc[idx[['HPS', 'DPV'],:,:], use_columns])
+    type_axis = axes.index('type')
+    rows = [slice(None)] * len(axes)
+    rows[type_axis] = eia_extra.positions('type', ['HPS', 'DPV'])
+    rows = tuple(rows)
+    eia_extra.values[rows] = eia_total_monthly.values[rows]
 
     # consolidate emission factors to match the state-level fuel codes
     fuel_factors = reduce_emission_factors(ef)
 
-    # Calculate co2 emissions for the state-level fuel categories
-    eia_extra['all fuel co2 (kg)'] = 0
-    eia_extra['elec fuel co2 (kg)'] = 0
-
-    fuels = [fuel for fuel in total_fuel_cats
-             if fuel in fuel_factors.keys()]
-    for fuel in fuels:
-        eia_extra.loc[idx[fuel,:,:],'all fuel co2 (kg)'] = \
-            eia_extra.loc[idx[fuel,:,:],'total fuel (mmbtu)'] * fuel_factors[fuel]
+    # Emission factor for each fuel on the type axis (0 if there isn't one),
+    # broadcast across the other axes
+    factors = np.array([fuel_factors[fuel]
+                        if fuel in fuel_factors and fuel in total_fuel_cats
+                        else 0 for fuel in eia_extra.axes['type']])
+    shape = [1] * len(axes)
+    shape[type_axis] = len(factors)
+    factors = factors.reshape(shape)
 
-        eia_extra.loc[idx[fuel,:,:],'elec fuel co2 (kg)'] = \
-            eia_extra.loc[idx[fuel,:,:],'elec fuel (mmbtu)'] * fuel_factors[fuel]
+    co2 = np.stack([eia_extra.measure('total fuel (mmbtu)') * factors,
+                    eia_extra.measure('elec fuel (mmbtu)') * factors],
+                   axis=-1)
+    extra_co2 = LabeledCube(co2, eia_extra.axes,
+                            ['all fuel co2 (kg)', 'elec fuel co2 (kg)'],
+                            eia_extra.mask).to_frame()
 
-    extra_co2 = (eia_extra.groupby(level=['type', 'year', 'month'])
-                 ['all fuel co2 (kg)', 'elec fuel co2 (kg)']
-                 .sum())
-
-    extra_gen_fuel = (eia_extra
-                      .drop(['all fuel co2 (kg)', 'elec fuel co2 (kg)'],
-                            axis=1))
+    extra_gen_fuel = eia_extra.to_frame()
 
     return extra_co2, extra_gen_fuel
 
@@ -374,26 +431,419 @@ def change_since_2005(df):
 
     df['change since 2005'] = (df['index (g/kwh)'] - index_2005) / index_2005
 
-def generation_index(gen_df, index_df, group_by='year'):
+def index_rollup(monthly, resolutions=('monthly', 'quarterly', 'annual'),
+                 group_by=None, rolling=False, calc_change_since_2005=True,
+                 gen_col='generation (mwh)', co2_col='final co2 (kg)',
+                 index_col='index (g/kwh)', lb_col='index (lb/mwh)'):
+    """
+    Roll monthly generation and co2 up to quarterly and annual (and
+    optionally rolling 12-month) totals in a single pass over sorted data,
+    and calculate the index, lb/MWh index, and change since 2005 for every
+    resolution.
+
+    inputs:
+        monthly (df): generation and co2 with 'year' and 'month' columns, plus
+            any group_by columns. Multiple rows per group/month are summed.
+        resolutions (list): any of 'monthly', 'quarterly', and 'annual'
+        group_by (list): columns (e.g. ['nerc']) to keep separate
+        rolling (bool): include rolling 12-month totals ('rolling' key).
+            Months without 12 months of data are NaN.
+        calc_change_since_2005 (bool): add a 'change since 2005' column
+        gen_col, co2_col, index_col, lb_col (str): column names
+
+    outputs:
+        dict: resolution name -> dataframe
+    """
+    group_by = list(group_by or [])
+    keys = group_by + ['year', 'month']
+    df = monthly.loc[:, keys + [gen_col, co2_col]].sort_values(keys)
+
+    if group_by:
+        group = df.groupby(group_by, sort=False).ngroup().values
+    else:
+        group = np.zeros(len(df), dtype=int)
+    year = df['year'].values.astype(int)
+    month = df['month'].values.astype(int)
+    values = df.loc[:, [gen_col, co2_col]].values.astype(float)
+
+    def reduce(period):
+        'Sum values over runs of the same group and period'
+        change = np.ones(len(group), dtype=bool)
+        change[1:] = (group[1:] != group[:-1]) | (period[1:] != period[:-1])
+        starts = np.flatnonzero(change)
+        return starts, np.add.reduceat(values, starts, axis=0)
+
+    # Collapse duplicate rows so each group has one row per month
+    ordinal = month_ordinal(year, month)
+    starts, values = reduce(ordinal)
+    group, year, month, ordinal = (group[starts], year[starts],
+                                   month[starts], ordinal[starts])
+    labels = df.iloc[starts][group_by].reset_index(drop=True)
+
+    # Index in 2005 for each group (co2 / generation over the year)
+    if calc_change_since_2005:
+        in_2005 = year == 2005
+        totals_2005 = np.zeros((group.max() + 1 if len(group) else 0, 2))
+        np.add.at(totals_2005, group[in_2005], values[in_2005])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            index_2005 = totals_2005[:, 1] / totals_2005[:, 0]
+
+    def finish(frame, grp, vals, extra_cols=None):
+        frame[gen_col] = vals[:, 0]
+        frame[co2_col] = vals[:, 1]
+        for col, col_values in (extra_cols or []):
+            frame[col] = col_values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frame[index_col] = vals[:, 1] / vals[:, 0]
+        if calc_change_since_2005:
+            frame['change since 2005'] = ((frame[index_col] - index_2005[grp])
+                                          / index_2005[grp])
+        frame[lb_col] = frame[index_col] * 2.2046
+        return frame
+
+    results = {}
+    if 'monthly' in resolutions:
+        frame = labels.copy()
+        frame['year'] = year
+        frame['month'] = month
+        results['monthly'] = finish(
+            frame, group, values,
+            [('datetime', month_ordinal_to_datetime(ordinal)),
+             ('quarter', ordinal_quarter(ordinal))])
+        results['monthly'] = results['monthly'].dropna(subset=[index_col])
+
+    if 'quarterly' in resolutions:
+        quarter = ordinal_quarter(ordinal)
+        q_starts, q_values = reduce(year * 4 + quarter)
+        frame = labels.iloc[q_starts].reset_index(drop=True)
+        frame['year'] = year[q_starts]
+        frame['quarter'] = quarter[q_starts]
+        frame = finish(frame, group[q_starts], q_values)
+        year_quarter = (frame['year'].astype(str) + ' Q'
+                        + frame['quarter'].astype(str))
+        frame.insert(frame.columns.get_loc(index_col) + 1, 'year_quarter',
+                     year_quarter)
+        results['quarterly'] = frame
+
+    if 'annual' in resolutions:
+        a_starts, a_values = reduce(year)
+        frame = labels.iloc[a_starts].reset_index(drop=True)
+        frame['year'] = year[a_starts]
+        results['annual'] = finish(frame, group[a_starts], a_values)
+
+    if rolling:
+        # Sum over the 12 months ending in each month. A row only has a value
+        # if all 12 months are present for the group.
+        key = group.astype(np.int64) * 10**6 + ordinal
+        cumulative = np.vstack([np.zeros((1, 2)), np.cumsum(values, axis=0)])
+        window_start = np.searchsorted(key, key - 11)
+        full_window = (np.arange(len(key)) - window_start) == 11
+        r_values = cumulative[1:] - cumulative[window_start]
+        r_values[~full_window] = np.nan
+        frame = labels.copy()
+        frame['year'] = year
+        frame['month'] = month
+        results['rolling'] = finish(
+            frame, group, r_values,
+            [('datetime', month_ordinal_to_datetime(ordinal))])
+
+    return results
+
+def region_index(facility_df, membership, region_types=None,
+                 gen_col='generation (mwh)', co2_col='final co2 (kg)',
+                 **kwargs):
+    """
+    Aggregate facility generation and co2 to every region in a
+    RegionMembership (states, NERC regions, custom groups, national) with
+    sparse matrix products, then calculate the index for each region with
+    index_rollup.
+
+    inputs:
+        facility_df (df): 'plant id', 'year', 'month', gen_col, and co2_col
+        membership (RegionMembership): plant x region memberships
+        region_types (list): only calculate these region sets
+        kwargs: passed to index_rollup
+
+    outputs:
+        dict: resolution name -> dataframe with 'region type' and 'region'
+            columns
+    """
+    regional = membership.aggregate(facility_df, [gen_col, co2_col],
+                                    keys=['year', 'month'],
+                                    region_types=region_types)
+
+    return index_rollup(regional, group_by=['region type', 'region'],
+                        gen_col=gen_col, co2_col=co2_col, **kwargs)
+
+def monthly_co2_gen(eia_facility, epa, eia_total, ef, state_fuel_cat):
+    """
+    National monthly generation and co2 from facility data (with adjusted
+    EPA emissions) plus EIA estimates for non-reporting facilities. Every
+    month is calculated independently, so this can be run on only new or
+    revised months and passed to update_index_rollup.
+
+    inputs:
+        eia_facility (df): EIA facility data for the months to calculate
+        epa (df): EPA facility data for the same months
+        eia_total (df): EIA state-level totals. Only months that are in
+            eia_facility are used.
+        ef (df): emission factors
+        state_fuel_cat (dict): facility fuel codes for each state-level type
+
+    outputs:
+        df: 'year', 'month', 'generation (mwh)', and 'final co2 (kg)'
+    """
+    co2, gen_fuels = facility_emission_gen(eia_facility, epa, state_fuel_cat,
+                                           None, export_state_cats=True,
+                                           print_status=False)
+
+    months = pd.MultiIndex.from_frame(gen_fuels.loc[:, ['year', 'month']])
+    in_months = pd.MultiIndex.from_frame(
+        eia_total.loc[:, ['year', 'month']]).isin(months)
+    extra_co2, extra_gen_fuel = extra_emissions_gen(
+        gen_fuels, eia_total.loc[in_months], ef)
+
+    monthly = pd.concat(
+        [gen_fuels.groupby(['year', 'month'])['generation (mwh)'].sum(),
+         co2.groupby(['year', 'month'])['final co2 (kg)'].sum()], axis=1)
+    extra = pd.concat(
+        [extra_gen_fuel.groupby(level=['year', 'month'])
+                       ['generation (mwh)'].sum(),
+         extra_co2.groupby(level=['year', 'month'])
+                  ['elec fuel co2 (kg)'].sum()
+                  .rename('final co2 (kg)')], axis=1)
+    monthly = monthly.add(extra, fill_value=0)
+    monthly.reset_index(inplace=True)
+
+    return monthly
+
+def update_index_rollup(results, new_monthly, group_by=None,
+                        calc_change_since_2005=True,
+                        gen_col='generation (mwh)', co2_col='final co2 (kg)',
+                        index_col='index (g/kwh)', lb_col='index (lb/mwh)'):
+    """
+    Update stored index_rollup results with new or revised months without
+    recalculating unchanged history. Months in new_monthly replace the
+    stored months, and only the quarters, years, and rolling 12-month
+    windows that include them are recalculated. If a 2005 month changes,
+    the change since 2005 is updated for every row of that group.
+
+    inputs:
+        results (dict): output of index_rollup (monthly, quarterly, annual,
+            and optionally rolling)
+        new_monthly (df): generation and co2 for the new/revised months, in
+            the same format as the input to index_rollup
+        group_by, calc_change_since_2005, gen_col, co2_col, index_col,
+            lb_col: the same arguments used to make results
+
+    outputs:
+        dict: updated results
+    """
+    group_by = list(group_by or [])
+    keys = group_by + ['year', 'month']
+    cols = dict(gen_col=gen_col, co2_col=co2_col, index_col=index_col,
+                lb_col=lb_col, calc_change_since_2005=calc_change_since_2005)
+
+    new = (new_monthly.groupby(keys)[[gen_col, co2_col]]
+                      .sum()
+                      .reset_index())
+    old = results['monthly'].loc[:, keys + [gen_col, co2_col]]
+    replaced = pd.MultiIndex.from_frame(old.loc[:, keys]).isin(
+        pd.MultiIndex.from_frame(new.loc[:, keys]))
+    monthly = pd.concat([old.loc[~replaced], new], ignore_index=True)
+
+    new_groups = (pd.MultiIndex.from_frame(
+        new.loc[:, group_by].drop_duplicates()) if group_by else None)
+
+    def row_groups(df):
+        'Position of each row in the affected groups (-1 if not affected)'
+        if not group_by:
+            return np.zeros(len(df), dtype=int)
+        return new_groups.get_indexer(
+            pd.MultiIndex.from_frame(df.loc[:, group_by]))
+
+    affected_years = pd.MultiIndex.from_frame(
+        new.loc[:, group_by + ['year']].drop_duplicates())
+
+    def affected(df):
+        'Rows of df in an affected group and year'
+        return pd.MultiIndex.from_frame(
+            df.loc[:, group_by + ['year']]).isin(affected_years)
+
+    # First new month in each affected group
+    first = pd.Series(month_ordinal(new['year'].values, new['month'].values))
+    first = first.groupby(row_groups(new)).min()
+
+    def after_first(df, months_before=0):
+        'Rows of df in an affected group on or after the first new month'
+        grp = row_groups(df)
+        ordinal = month_ordinal(df['year'].values, df['month'].values)
+        start = np.where(grp >= 0, first.reindex(grp).values, np.inf)
+        return (grp >= 0) & (ordinal >= start - months_before)
+
+    # Months needed to recalculate the affected periods: every month of the
+    # affected years, 2005 (for the change since 2005), and the 11 months
+    # before the first new month (for rolling windows)
+    needed = (affected(monthly)
+              | ((row_groups(monthly) >= 0)
+                 & (monthly['year'].values == 2005))
+              | after_first(monthly, months_before=11))
+    rollup = index_rollup(monthly.loc[needed],
+                          resolutions=('monthly', 'quarterly', 'annual'),
+                          group_by=group_by, rolling='rolling' in results,
+                          **cols)
+
+    def splice(name, replace_old, replace_new):
+        'Swap the rows of a stored result for recalculated rows'
+        df = pd.concat([results[name].loc[~replace_old],
+                        rollup[name].loc[replace_new]], ignore_index=True)
+        sort_cols = group_by + [c for c in ['year', 'quarter', 'month']
+                                if c in df.columns]
+        df.sort_values(sort_cols, inplace=True)
+        df.reset_index(drop=True, inplace=True)
+        return df
+
+    updated = dict(results)
+    for name in ['monthly', 'quarterly', 'annual']:
+        if name == 'monthly':
+            # Only new months change (other months in affected years are
+            # recalculated with the same values)
+            new_keys = pd.MultiIndex.from_frame(new.loc[:, keys])
+            updated[name] = splice(
+                name,
+                pd.MultiIndex.from_frame(
+                    results[name].loc[:, keys]).isin(new_keys),
+                pd.MultiIndex.from_frame(
+                    rollup[name].loc[:, keys]).isin(new_keys))
+        else:
+            updated[name] = splice(name, affected(results[name]),
+                                   affected(rollup[name]))
+
+    if 'rolling' in results:
+        updated['rolling'] = splice('rolling', after_first(results['rolling']),
+                                    after_first(rollup['rolling']))
+
+    # A revised 2005 changes the baseline for every row in the group
+    if calc_change_since_2005 and (new['year'] == 2005).any():
+        annual = rollup['annual']
+        base = annual.loc[annual['year'] == 2005]
+        base_groups = row_groups(base)
+        index_2005 = pd.Series(base[co2_col].values / base[gen_col].values,
+                               index=base_groups)
+        changed = np.unique(row_groups(new.loc[new['year'] == 2005]))
+        for name, df in updated.items():
+            grp = row_groups(df)
+            rows = np.isin(grp, changed)
+            i_2005 = index_2005.reindex(grp[rows]).values
+            df.loc[rows, 'change since 2005'] = (
+                (df.loc[rows, index_col].values - i_2005) / i_2005)
+
+    return updated
+
+def generation_index(gen_df, index_df, group_by='year',
+                     co2_col='elec fuel fossil co2 (kg)',
+                     final_co2_col='final co2 (kg)',
+                     gen_col='generation (mwh)'):
     """
     Calculate the emissions intensity of each fuel in each time period. Use the
     adjusted total emissions from the index dataframe to ensure that the weighted
     sum of fuel emission intensities will equal the total index value.
-    """
-    final_adj_co2 = index_df.loc[:,'final co2 (kg)'].copy()
 
-    calc_total_co2 = (gen_df.groupby(group_by)['elec fuel fossil co2 (kg)']
-                            .sum()
-                            .values)
-#     calc_total_co2 = calc_total_co2.reset_index()
+    Fuel rows are matched to index rows on the group_by columns, so group_by
+    can include region columns (e.g. ['region type', 'region', 'year']) and
+    the rows of gen_df and index_df don't need to be in the same order.
 
+    inputs:
+        gen_df (df): fuel-level co2 and generation with the group_by columns
+        index_df (df): total final co2 with one row for each group
+        group_by (str or list): columns that define a group (region/period)
+        co2_col (str): fuel-level co2 that is scaled to the final total
+        final_co2_col (str): total co2 in index_df
+        gen_col (str): generation in gen_df
 
-    for fuel in gen_df['fuel category'].unique():
-        gen_df.loc[gen_df['fuel category']==fuel, 'adjusted co2 (kg)'] = \
-        (gen_df.loc[gen_df['fuel category']==fuel, 'elec fuel fossil co2 (kg)']
-         / calc_total_co2 * final_adj_co2.values)
-
-    gen_df['adjusted index (g/kwh)'] = (gen_df['adjusted co2 (kg)']
-                                        / gen_df['generation (mwh)'])
+    outputs:
+        df: gen_df with adjusted co2 and adjusted index columns added
+    """
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    group_by = list(group_by)
+
+    calc_total_co2 = gen_df.groupby(group_by)[co2_col].transform('sum')
+    final_adj_co2 = (index_df.groupby(group_by)[final_co2_col].sum()
+                             .reindex(pd.MultiIndex.from_frame(
+                                 gen_df.loc[:, group_by]))
+                             .values)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gen_df['adjusted co2 (kg)'] = (gen_df[co2_col].values
+                                       / calc_total_co2.values
+                                       * final_adj_co2)
+        gen_df['adjusted index (g/kwh)'] = (gen_df['adjusted co2 (kg)']
+                                            / gen_df[gen_col])
     gen_df['adjusted index (lb/mwh)'] = (gen_df['adjusted index (g/kwh)']
                                          * 2.2046)
+
+    return gen_df
+
+def region_generation_index(fuel_df, index_results, membership=None,
+                            resolutions=('monthly', 'annual'),
+                            region_types=None, fuel_col='fuel category',
+                            co2_col='elec fuel fossil co2 (kg)',
+                            final_co2_col='final co2 (kg)',
+                            gen_col='generation (mwh)'):
+    """
+    Adjusted co2 and emissions intensity of every fuel in every region and
+    period in a single call. Fuel-level co2 and generation are summed to
+    each region, fuel, and period, and then scaled with generation_index so
+    the fuel values in a region add up to the region's final co2.
+
+    inputs:
+        fuel_df (df): 'year', 'month', fuel_col, gen_col, and co2_col. Either
+            facility data with 'plant id' (aggregated with membership) or
+            data that already has 'region type' and 'region' columns.
+        index_results (dict): resolution -> df from region_index
+        membership (RegionMembership): plant x region memberships, only
+            needed for facility data
+        resolutions (list): any of 'monthly', 'quarterly', and 'annual'
+        region_types (list): only calculate these region sets
+        fuel_col, co2_col, final_co2_col, gen_col (str): column names
+
+    outputs:
+        dict: resolution name -> dataframe with 'region type', 'region',
+            fuel_col, the period columns, and adjusted co2/index columns
+    """
+    regions = ['region type', 'region']
+    value_cols = [gen_col, co2_col]
+    monthly_keys = ['year', 'month', fuel_col]
+
+    if 'region type' in fuel_df.columns:
+        regional = fuel_df.loc[:, regions + monthly_keys + value_cols]
+        if region_types is not None:
+            regional = regional.loc[regional['region type']
+                                    .isin(region_types)]
+    else:
+        regional = membership.aggregate(fuel_df, value_cols,
+                                        keys=monthly_keys,
+                                        region_types=region_types)
+
+    periods = {'monthly': ['year', 'month'],
+               'quarterly': ['year', 'quarter'],
+               'annual': ['year']}
+    if 'quarterly' in resolutions:
+        regional = regional.assign(quarter=ordinal_quarter(month_ordinal(
+            regional['year'].values, regional['month'].values)))
+
+    results = {}
+    for resolution in resolutions:
+        keys = regions + periods[resolution]
+        gen_df = (regional.groupby(keys + [fuel_col])[value_cols]
+                          .sum()
+                          .reset_index())
+        results[resolution] = generation_index(gen_df,
+                                               index_results[resolution],
+                                               group_by=keys,
+                                               co2_col=co2_col,
+                                               final_co2_col=final_co2_col,
+                                               gen_col=gen_col)
+
+    return results
@@ -0,0 +1,173 @@
+# coding: utf-8
+
+import os
+import pandas as pd
+import numpy as np
+from util.utils import df_hash, get_cache_path
+
+
+def fit_location_tree(labeled, cache=True):
+    """
+    Build a haversine BallTree over the lat/lon of plants with known NERC
+    labels. Each plant is included once, using its most recent labeled year.
+    The fitted tree is cached on disk, keyed by a hash of the input data.
+
+    inputs:
+        labeled (df): plant-years with columns 'plant id', 'year', 'lat',
+            'lon', and 'nerc'. Rows without a nerc label or lat/lon are
+            dropped.
+        cache (bool): load/save the fitted tree from the cache folder
+
+    outputs:
+        tree (BallTree): tree fit on lat/lon (radians)
+        nerc_codes (array): integer code of the nerc label for each point in
+            the tree
+        nerc_names (array): nerc label for each integer code
+    """
+    from sklearn.neighbors import BallTree
+    import joblib
+
+    cols = ['plant id', 'year', 'lat', 'lon', 'nerc']
+    points = (labeled.loc[:, cols]
+                     .dropna()
+                     .sort_values(['plant id', 'year'])
+                     .drop_duplicates(subset=['plant id'], keep='last')
+                     .reset_index(drop=True))
+
+    path = get_cache_path('nerc_tree_{}.pkl'.format(df_hash(points)))
+    if cache and os.path.exists(path):
+        return joblib.load(path)
+
+    nerc_codes, nerc_names = pd.factorize(points['nerc'], sort=True)
+    X = np.radians(points.loc[:, ['lat', 'lon']].values.astype(float))
+    tree = BallTree(X, metric='haversine')
+
+    result = (tree, nerc_codes, np.asarray(nerc_names))
+    if cache:
+        joblib.dump(result, path)
+
+    return result
+
+
+def query_nerc(tree, nerc_codes, nerc_names, lat, lon, k=5):
+    """
+    Predict NERC labels for many points with a single batched tree query.
+    Neighbors vote with weights of 1/distance.
+
+    inputs:
+        tree, nerc_codes, nerc_names: outputs of fit_location_tree
+        lat, lon (array-like): coordinates of the points to label
+        k (int): number of neighbors
+
+    outputs:
+        labels (array): predicted nerc label for each point
+        confidence (array): weighted fraction of neighbors that agree with
+            the predicted label (0-1)
+    """
+    X = np.radians(np.column_stack([lat, lon]).astype(float))
+    k = min(k, len(nerc_codes))
+    dist, ind = tree.query(X, k=k)
+
+    # Exact matches (distance 0) dominate the vote
+    weights = 1 / np.maximum(dist, 1e-9)
+
+    votes = np.zeros((len(X), len(nerc_names)))
+    rows = np.repeat(np.arange(len(X)), k)
+    np.add.at(votes, (rows, nerc_codes[ind].ravel()), weights.ravel())
+
+    best = votes.argmax(axis=1)
+    confidence = votes[np.arange(len(X)), best] / votes.sum(axis=1)
+
+    return nerc_names[best], confidence
+
+
+def state_nerc_mode(labeled):
+    """
+    Most common NERC region for labeled plants in each state, and the
+    fraction of the state's plants in that region. Used for plants that have
+    a state but no lat/lon.
+
+    outputs:
+        df: index of state, columns 'nerc' and 'confidence'
+    """
+    counts = (labeled.dropna(subset=['state', 'nerc'])
+                     .drop_duplicates(subset=['plant id', 'nerc'])
+                     .groupby(['state', 'nerc'])
+                     .size())
+    share = counts / counts.groupby(level='state').transform('sum')
+    share = share.sort_values(ascending=False)
+    mode = share.reset_index().drop_duplicates(subset=['state'])
+    mode.columns = ['state', 'nerc', 'confidence']
+
+    return mode.set_index('state')
+
+
+def assign_nerc_labels(plants, nercs, k=5, cache=True, export_path=None):
+    """
+    Assign a NERC region to every plant-year. Plant-years with a label from
+    EIA-860 keep that label. All others are labeled in one batched query
+    against a BallTree of labeled plants, or by the most common region in
+    their state if they don't have lat/lon data.
+
+    inputs:
+        plants (df): unique plant-years with columns 'plant id', 'year',
+            'lat', 'lon', and 'state'
+        nercs (df): known labels with columns 'plant id', 'year', 'nerc'
+        k (int): number of neighbors used to label each plant
+        cache (bool): use the cached BallTree if the labeled data haven't
+            changed
+        export_path (str): if given, write the results to this csv file
+
+    outputs:
+        df: 'plant id', 'lat', 'lon', 'nerc', 'state', 'year', and
+            'confidence' (1 for plant-years with a label from EIA-860)
+    """
+    df = pd.merge(plants, nercs.loc[:, ['plant id', 'year', 'nerc']],
+                  on=['plant id', 'year'], how='left')
+    df = df.drop_duplicates(subset=['plant id', 'year', 'nerc'])
+    df['confidence'] = np.where(df['nerc'].notnull(), 1., np.nan)
+
+    labeled = df.loc[df['nerc'].notnull()]
+    unknown = df['nerc'].isnull()
+    has_loc = df['lat'].notnull() & df['lon'].notnull()
+
+    mask = unknown & has_loc
+    if mask.any():
+        tree, nerc_codes, nerc_names = fit_location_tree(labeled, cache=cache)
+        labels, confidence = query_nerc(tree, nerc_codes, nerc_names,
+                                        df.loc[mask, 'lat'].values,
+                                        df.loc[mask, 'lon'].values, k=k)
+        df.loc[mask, 'nerc'] = labels
+        df.loc[mask, 'confidence'] = confidence
+
+    mask = unknown & ~has_loc & df['state'].notnull()
+    if mask.any():
+        mode = state_nerc_mode(labeled)
+        states = df.loc[mask, 'state']
+        df.loc[mask, 'nerc'] = states.map(mode['nerc']).values
+        df.loc[mask, 'confidence'] = states.map(mode['confidence']).values
+
+    cols = ['plant id', 'lat', 'lon', 'nerc', 'state', 'year', 'confidence']
+    df = df.loc[:, cols].sort_values(['plant id', 'year'])
+    df.reset_index(drop=True, inplace=True)
+
+    if export_path:
+        df.to_csv(export_path, index=False)
+
+    return df
+
+
+def region_changes(nercs):
+    """
+    Count how often plants are assigned to each combination of NERC regions
+    across years (e.g. a plant labeled SPP in some years and MRO in others).
+
+    outputs:
+        Series: number of plants for each tuple of regions
+    """
+    unique = nercs.dropna(subset=['nerc']).drop_duplicates(
+        subset=['plant id', 'nerc'])
+    combos = unique.groupby('plant id')['nerc'].agg(tuple)
+    combos = combos.loc[combos.str.len() > 1]
+
+    return combos.value_counts()
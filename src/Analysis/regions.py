@@ -0,0 +1,291 @@
+# coding: utf-8
+
+import pandas as pd
+import numpy as np
+from util.utils import FacilityLabels
+
+
+class RegionMembership(object):
+    """
+    Sparse plant x region membership matrices (one per year) for any number
+    of region sets, which can overlap (e.g. states, NERC regions, balancing
+    authorities, custom groups, and the national total). Facility-level data
+    are aggregated to every region with a single sparse matrix product per
+    year, rather than a merge or isin filter for each region.
+
+    Matrix values are the fraction of a plant that belongs to a region
+    (usually 1).
+
+    inputs:
+        plant_ids (array): plant ids for the rows of each matrix
+        regions (MultiIndex): (region type, region) for the columns of each
+            matrix
+        matrices (dict): year -> scipy.sparse matrix (plants x regions)
+        default: sparse matrix used for years that aren't in matrices
+    """
+
+    def __init__(self, plant_ids, regions, matrices=None, default=None):
+        from scipy import sparse
+
+        self.plant_ids = pd.Index(plant_ids)
+        self.regions = pd.MultiIndex.from_tuples(list(regions),
+                                                 names=['region type',
+                                                        'region'])
+        self.matrices = {year: sparse.csr_matrix(m)
+                         for year, m in (matrices or {}).items()}
+        self.default = (sparse.csr_matrix(default) if default is not None
+                        else None)
+
+    @classmethod
+    def from_labels(cls, labels, region_cols=('state', 'nerc'), years=None,
+                    national=True):
+        """
+        Build memberships from facility labels. If the labels have a year
+        column, plants without a label in a year use their most recent label
+        (the same as FacilityLabels).
+
+        inputs:
+            labels (df or FacilityLabels): 'plant id', optional 'year', and
+                the region_cols
+            region_cols (list): each column is a separate region set
+            years (list): years to build matrices for. Defaults to the years
+                in labels, or a single matrix for all years if there isn't a
+                year column.
+            national (bool): add a ('national', 'USA') region with every plant
+        """
+        from scipy import sparse
+
+        if not isinstance(labels, FacilityLabels):
+            labels = FacilityLabels(labels)
+        plant_ids = labels.plant_ids
+        n_plants = len(plant_ids)
+
+        regions, uniques = [], []
+        for col in region_cols:
+            values = pd.Index(labels.label_df[col].dropna().unique())
+            values = values.sort_values()
+            uniques.append(values)
+            regions.extend((col, value) for value in values)
+        if national:
+            regions.append(('national', 'USA'))
+
+        def build(year):
+            rows, cols = [], []
+            offset = 0
+            for col, values in zip(region_cols, uniques):
+                codes = values.get_indexer(labels.get(col, plant_ids, year))
+                found = codes >= 0
+                rows.append(np.flatnonzero(found))
+                cols.append(codes[found] + offset)
+                offset += len(values)
+            if national:
+                rows.append(np.arange(n_plants))
+                cols.append(np.full(n_plants, offset))
+            rows, cols = np.concatenate(rows), np.concatenate(cols)
+            return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                     shape=(n_plants, len(regions)))
+
+        if years is None and labels.has_year:
+            years = np.unique(labels.label_df['year'].values.astype(int))
+        if years is None:
+            return cls(plant_ids, regions, default=build(None))
+
+        return cls(plant_ids, regions, {year: build(year) for year in years})
+
+    @classmethod
+    def from_plant_dict(cls, plant_dict, region_type='nerc', national=True):
+        """
+        Build memberships from a dict of dicts (year -> region -> list of
+        plant ids), the format used by Analysis.capacity.
+        """
+        from scipy import sparse
+
+        plant_ids = pd.Index(np.unique(np.concatenate(
+            [np.asarray(plants) for regions in plant_dict.values()
+             for plants in regions.values()])))
+        names = sorted({region for regions in plant_dict.values()
+                        for region in regions})
+        regions = [(region_type, name) for name in names]
+        if national:
+            regions.append(('national', 'USA'))
+
+        matrices = {}
+        for year, year_regions in plant_dict.items():
+            rows, cols = [], []
+            for region, plants in year_regions.items():
+                pos = plant_ids.get_indexer(plants)
+                rows.append(pos)
+                cols.append(np.full(len(pos), names.index(region)))
+            rows, cols = np.concatenate(rows), np.concatenate(cols)
+            if national:
+                in_year = np.unique(rows)
+                rows = np.concatenate([rows, in_year])
+                cols = np.concatenate([cols, np.full(len(in_year),
+                                                     len(names))])
+            matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                       shape=(len(plant_ids), len(regions)))
+            # Plants listed twice in a region only count once
+            matrix.data = np.minimum(matrix.data, 1)
+            matrices[year] = matrix
+
+        return cls(plant_ids, regions, matrices)
+
+    def add_groups(self, region_type, groups):
+        """
+        Return a new RegionMembership with an extra region set that is the
+        same in every year (e.g. custom groups of plants).
+
+        inputs:
+            region_type (str): name of the region set
+            groups (dict): region -> list of plant ids, or region -> dict of
+                plant id -> fraction of the plant in the region
+        """
+        from scipy import sparse
+
+        group_ids = [np.asarray(list(plants)) for plants in groups.values()]
+        plant_ids = self.plant_ids.union(pd.Index(np.unique(
+            np.concatenate(group_ids))))
+        old_rows = plant_ids.get_indexer(self.plant_ids)
+
+        rows, cols, weights = [], [], []
+        for i, plants in enumerate(groups.values()):
+            rows.append(plant_ids.get_indexer(list(plants)))
+            cols.append(np.full(len(plants), i))
+            if isinstance(plants, dict):
+                weights.append(np.asarray(list(plants.values()), dtype=float))
+            else:
+                weights.append(np.ones(len(plants)))
+        new = sparse.csr_matrix((np.concatenate(weights),
+                                 (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(len(plant_ids), len(groups)))
+
+        def expand(matrix):
+            'Move rows to the new plant ids and add the new columns'
+            matrix = matrix.tocoo()
+            matrix = sparse.csr_matrix((matrix.data,
+                                        (old_rows[matrix.row], matrix.col)),
+                                       shape=(len(plant_ids), matrix.shape[1]))
+            return sparse.hstack([matrix, new], format='csr')
+
+        regions = list(self.regions) + [(region_type, name)
+                                        for name in groups.keys()]
+        matrices = {year: expand(m) for year, m in self.matrices.items()}
+        default = expand(self.default) if self.default is not None else None
+
+        return RegionMembership(plant_ids, regions, matrices, default)
+
+    def matrix(self, year=None):
+        """
+        Sparse plant x region matrix for a year. Years without a matrix use
+        the nearest earlier year (e.g. data newer than the labels), or the
+        latest year if there isn't an earlier one.
+        """
+        if year in self.matrices:
+            return self.matrices[year]
+        if self.default is not None:
+            return self.default
+        if not self.matrices:
+            raise KeyError('No region membership for {}'.format(year))
+
+        years = sorted(self.matrices)
+        earlier = [y for y in years if year is not None and y <= year]
+
+        return self.matrices[earlier[-1] if earlier else years[-1]]
+
+    def group_matrix(self, df, keys=('year', 'month'), plant_col='plant id',
+                     year_col='year', region_types=None):
+        """
+        Sparse matrix that sums the rows of df to every region and key
+        combination. Each row is weighted by the plant's membership fraction
+        in each region. Plants that aren't in the membership matrices are
+        dropped. Multiplying the matrix by any (rows x n) array of values
+        aggregates all n columns at once.
+
+        inputs:
+            df (df): facility data with plant_col and keys
+            keys (list): columns to keep separate (e.g. year, month, fuel
+                category). Should include year_col if memberships change by
+                year.
+            plant_col (str): column with plant ids
+            year_col (str): column used to pick the matrix for each row
+            region_types (list): only include these region sets
+
+        outputs:
+            groups (df): 'region type', 'region', and the keys for every
+                region/key combination with at least one plant
+            matrix (csr): shape (len(groups), len(df))
+        """
+        from scipy import sparse
+
+        keys = list(keys)
+        region_mask = np.ones(len(self.regions), dtype=bool)
+        if region_types is not None:
+            region_mask = self.regions.get_level_values(
+                'region type').isin(region_types)
+        regions = self.regions[region_mask]
+
+        codes, uniques = pd.factorize(pd.MultiIndex.from_frame(
+            df.loc[:, keys]), sort=True)
+        n_keys = max(len(uniques), 1)
+        pos = self.plant_ids.get_indexer(df[plant_col])
+
+        if year_col in df.columns and self.matrices:
+            years = df[year_col].values
+            year_list = np.unique(years)
+        else:
+            years = None
+            year_list = [None]
+
+        out, cols, weights = [], [], []
+        for year in year_list:
+            selected = pos >= 0
+            if years is not None:
+                selected &= years == year
+            rows = np.flatnonzero(selected)
+            member = self.matrix(year)[:, region_mask][pos[rows]].tocoo()
+            out.append(member.col.astype(np.int64) * n_keys
+                       + codes[rows[member.row]])
+            cols.append(rows[member.row])
+            weights.append(member.data)
+
+        out = np.concatenate(out)
+        ids, inverse = np.unique(out, return_inverse=True)
+        matrix = sparse.csr_matrix((np.concatenate(weights),
+                                    (inverse, np.concatenate(cols))),
+                                   shape=(len(ids), len(df)))
+
+        groups = pd.DataFrame(
+            {'region type': regions.get_level_values(0)[ids // n_keys],
+             'region': regions.get_level_values(1)[ids // n_keys]})
+        for i, key in enumerate(keys):
+            groups[key] = np.asarray(uniques.get_level_values(i))[ids % n_keys]
+
+        return groups, matrix
+
+    def aggregate(self, df, value_cols, keys=('year', 'month'),
+                  plant_col='plant id', year_col='year', region_types=None):
+        """
+        Sum facility-level values to every region with group_matrix.
+
+        inputs:
+            df (df): facility data with plant_col, keys, and value_cols
+            value_cols (list): columns to sum
+            keys, plant_col, year_col, region_types: see group_matrix
+
+        outputs:
+            df: 'region type', 'region', the keys, and the summed value_cols
+                for every region/key combination with at least one plant
+        """
+        value_cols = list(value_cols)
+        groups, matrix = self.group_matrix(df, keys, plant_col=plant_col,
+                                           year_col=year_col,
+                                           region_types=region_types)
+        values = np.nan_to_num(df.loc[:, value_cols].values.astype(float))
+        groups = pd.concat([groups, pd.DataFrame(matrix @ values,
+                                                 columns=value_cols)], axis=1)
+
+        groups.sort_values(['region type', 'region'] + list(keys),
+                           inplace=True)
+        groups.reset_index(drop=True, inplace=True)
+
+        return groups
@@ -0,0 +1,256 @@
+# coding: utf-8
+
+import pandas as pd
+import numpy as np
+from Analysis.regions import RegionMembership
+
+
+def facility_fuel_co2(co2, gen_fuels, fuel_col='type',
+                      gen_col='generation (mwh)',
+                      fossil_col='elec fuel fossil co2 (kg)'):
+    """
+    Split the final co2 of each facility-month (from facility_emission_gen)
+    between the fuels used at the facility. Co2 is split by the calculated
+    elec fuel fossil co2 of each fuel, or by generation if the facility
+    doesn't have any calculated fossil co2 in a month.
+
+    inputs:
+        co2 (df): 'plant id', 'year', 'month', and 'final co2 (kg)'
+        gen_fuels (df): 'plant id', 'year', 'month', fuel_col, gen_col, and
+            fossil_col
+
+    outputs:
+        df: 'plant id', 'year', 'month', fuel_col, gen_col, and
+            'final co2 (kg)' for each facility, fuel, and month
+    """
+    keys = ['plant id', 'year', 'month']
+    df = (gen_fuels.groupby(keys + [fuel_col])[[gen_col, fossil_col]]
+                   .sum()
+                   .reset_index())
+
+    plant_co2 = (co2.groupby(keys)['final co2 (kg)'].sum()
+                    .reindex(pd.MultiIndex.from_frame(df.loc[:, keys]))
+                    .fillna(0)
+                    .values)
+
+    grouped = df.groupby(keys)
+    fossil_total = grouped[fossil_col].transform('sum').values
+    gen_total = grouped[gen_col].transform('sum').values
+    n_fuels = grouped[gen_col].transform('size').values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(fossil_total > 0,
+                          df[fossil_col].values / fossil_total,
+                          np.where(gen_total > 0,
+                                   df[gen_col].values / gen_total,
+                                   1.0 / n_fuels))
+
+    df['final co2 (kg)'] = plant_co2 * weight
+    df.drop(columns=fossil_col, inplace=True)
+
+    return df
+
+
+def scenario_row_changes(df, scenarios, membership=None, fuel_col='type',
+                         gen_col='generation (mwh)',
+                         co2_col='final co2 (kg)'):
+    """
+    Arrays that describe how each scenario changes each row of facility
+    fuel data.
+
+    Each scenario is a dict that can have the keys:
+        'shift': list of dicts with 'from' and 'to' fuels, the 'fraction' of
+            'from' generation that is moved, and an optional 'intensity'
+            (g/kWh) of the new generation. The default intensity is the
+            national average of the 'to' fuel in each month, or in the
+            year (then all years) if the fuel has no generation that month.
+        'retire': list of plant ids that don't generate
+        'replace with': fuel that replaces generation from retired plants
+            (at the same default intensity as shifts). If not given, the
+            generation of retired plants is removed, so scenario generation
+            is lower and the index is that of the remaining facilities.
+        'region': [region type, region] limits the scenario to plants in a
+            region of membership
+        'start year', 'end year': limit the scenario to these years
+
+    Moved generation stays with the original facility, so it counts toward
+    the same regions.
+
+    outputs:
+        keep (array): scenarios x rows fraction of each row that is kept
+        added_gen (array): scenarios x rows generation added to each row
+        added_co2 (array): scenarios x rows co2 from the added generation
+    """
+    n_rows = len(df)
+    fuel = df[fuel_col].values
+    year = df['year'].values
+    gen = np.nan_to_num(df[gen_col].values.astype(float))
+
+    # Average intensity (kg/MWh = g/kWh) of each fuel in each month
+    month_codes, months = pd.factorize(
+        pd.MultiIndex.from_frame(df.loc[:, ['year', 'month']]))
+    fuel_codes, fuels = pd.factorize(fuel)
+    fuels = pd.Index(fuels)
+    cell = month_codes * len(fuels) + fuel_codes
+    size = len(months) * len(fuels)
+    fuel_gen = np.bincount(cell, weights=gen, minlength=size).reshape(
+        len(months), len(fuels))
+    fuel_co2 = np.bincount(cell, weights=np.nan_to_num(
+        df[co2_col].values.astype(float)), minlength=size).reshape(
+        len(months), len(fuels))
+
+    # Annual and all-year totals for months without generation from a fuel
+    month_years, years = pd.factorize(months.get_level_values(0))
+    annual_gen = np.zeros((len(years), len(fuels)))
+    annual_co2 = np.zeros((len(years), len(fuels)))
+    np.add.at(annual_gen, month_years, fuel_gen)
+    np.add.at(annual_co2, month_years, fuel_co2)
+
+    def per_mwh(co2, gen):
+        'co2 / gen, or NaN without generation'
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(gen > 0, co2 / gen, np.nan)
+
+    fuel_intensity = per_mwh(fuel_co2, fuel_gen)
+    annual_intensity = per_mwh(annual_co2, annual_gen)
+    total_intensity = per_mwh(annual_co2.sum(axis=0),
+                              annual_gen.sum(axis=0))
+
+    def average_intensity(to_fuel):
+        'Average intensity of a fuel in the month (or year) of each row'
+        pos = fuels.get_indexer([to_fuel])[0]
+        if pos < 0 or np.isnan(total_intensity[pos]):
+            raise KeyError('No generation from {} to use for the '
+                           'intensity'.format(to_fuel))
+        values = fuel_intensity[month_codes, pos]
+        values = np.where(np.isnan(values),
+                          annual_intensity[month_years[month_codes], pos],
+                          values)
+        return np.where(np.isnan(values), total_intensity[pos], values)
+
+    plant_pos = None
+    if membership is not None:
+        plant_pos = membership.plant_ids.get_indexer(df['plant id'])
+
+    def in_scope(spec):
+        'Rows in the region and years of a scenario'
+        scope = np.ones(n_rows, dtype=bool)
+        if 'start year' in spec:
+            scope &= year >= spec['start year']
+        if 'end year' in spec:
+            scope &= year <= spec['end year']
+        if 'region' in spec:
+            if membership is None:
+                raise ValueError('A RegionMembership is needed for '
+                                 'scenarios with a region')
+            col = membership.regions.get_loc(tuple(spec['region']))
+            in_region = np.zeros(n_rows, dtype=bool)
+            for y in np.unique(year):
+                rows = np.flatnonzero((year == y) & (plant_pos >= 0))
+                member = membership.matrix(y)[:, col].toarray().ravel()
+                in_region[rows] = member[plant_pos[rows]] > 0
+            scope &= in_region
+        return scope
+
+    keep = np.ones((len(scenarios), n_rows))
+    added_gen = np.zeros((len(scenarios), n_rows))
+    added_co2 = np.zeros((len(scenarios), n_rows))
+
+    for i, spec in enumerate(scenarios.values()):
+        scope = in_scope(spec)
+
+        for shift in spec.get('shift', []):
+            fraction = float(shift['fraction'])
+            if not 0 <= fraction <= 1:
+                raise ValueError('Shift fractions must be between 0 and 1')
+            rows = scope & (fuel == shift['from'])
+            intensity = shift.get('intensity')
+            if intensity is None:
+                intensity = average_intensity(shift['to'])
+            moved = np.where(rows, gen * fraction * keep[i], 0)
+            keep[i, rows] *= 1 - fraction
+            added_gen[i] += moved
+            added_co2[i] += moved * intensity
+
+        if 'retire' in spec:
+            rows = scope & np.isin(df['plant id'].values, spec['retire'])
+            # Generation shifted to a retired plant is retired too
+            retired = np.where(rows, gen * keep[i] + added_gen[i], 0)
+            keep[i, rows] = 0
+            added_gen[i, rows] = 0
+            added_co2[i, rows] = 0
+            if spec.get('replace with') is not None:
+                added_gen[i] += retired
+                added_co2[i] += retired * average_intensity(
+                    spec['replace with'])
+
+    return keep, added_gen, added_co2
+
+
+def scenario_index(facility_fuel_df, scenarios, membership=None,
+                   region_types=None, fuel_col='type',
+                   gen_col='generation (mwh)', co2_col='final co2 (kg)'):
+    """
+    Monthly index for a batch of counterfactual scenarios in every region.
+    Scenario generation and co2 are (scenarios x rows) arrays, and every
+    scenario is aggregated to every region and month with one sparse matrix
+    product.
+
+    Only facility data are included (not the EIA estimates of
+    non-reporting facilities), so the historical values are for reporting
+    facilities.
+
+    inputs:
+        facility_fuel_df (df): 'plant id', 'year', 'month', fuel_col,
+            gen_col, and co2_col (e.g. from facility_fuel_co2)
+        scenarios (dict): scenario name -> scenario definition (see
+            scenario_row_changes)
+        membership (RegionMembership): plant x region memberships. If None,
+            only national totals are calculated.
+        region_types (list): only calculate these region sets
+        fuel_col, gen_col, co2_col (str): column names
+
+    outputs:
+        df: 'region type', 'region', 'year', 'month', 'scenario', and the
+            generation, co2, index, historical index, and change from the
+            historical index for each scenario
+    """
+    df = facility_fuel_df.reset_index(drop=True)
+    keep, added_gen, added_co2 = scenario_row_changes(
+        df, scenarios, membership, fuel_col=fuel_col, gen_col=gen_col,
+        co2_col=co2_col)
+
+    if membership is None:
+        plant_ids = np.unique(df['plant id'].values)
+        membership = RegionMembership(
+            plant_ids, [('national', 'USA')],
+            default=np.ones((len(plant_ids), 1)))
+    groups, matrix = membership.group_matrix(df, keys=['year', 'month'],
+                                             region_types=region_types)
+    order = groups.sort_values(['region type', 'region', 'year',
+                                'month']).index.values
+    groups, matrix = groups.iloc[order].reset_index(drop=True), matrix[order]
+
+    gen = np.nan_to_num(df[gen_col].values.astype(float))
+    co2 = np.nan_to_num(df[co2_col].values.astype(float))
+
+    # rows x (historical + scenarios) arrays
+    scen_gen = np.column_stack([gen, (gen * keep + added_gen).T])
+    scen_co2 = np.column_stack([co2, (co2 * keep + added_co2).T])
+    region_gen = np.asarray(matrix @ scen_gen)
+    region_co2 = np.asarray(matrix @ scen_co2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        region_index = region_co2 / region_gen
+
+    names = list(scenarios.keys())
+    n_groups = len(groups)
+    out = groups.iloc[np.tile(np.arange(n_groups), len(names))]
+    out = out.reset_index(drop=True)
+    out['scenario'] = np.repeat(names, n_groups)
+    out[gen_col] = region_gen[:, 1:].T.ravel()
+    out[co2_col] = region_co2[:, 1:].T.ravel()
+    out['index (g/kwh)'] = region_index[:, 1:].T.ravel()
+    out['historical index (g/kwh)'] = np.tile(region_index[:, 0], len(names))
+    out['change from historical (g/kwh)'] = (out['index (g/kwh)']
+                                             - out['historical index (g/kwh)'])
+
+    return out
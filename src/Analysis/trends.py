@@ -0,0 +1,111 @@
+# coding: utf-8
+
+import pandas as pd
+import numpy as np
+
+
+def linear_trends(df, x_col, y_col, group_cols):
+    """
+    Least squares linear trend of y_col on x_col for every group, using the
+    closed-form solution on group sums rather than fitting each series
+    separately. Rows with a missing x or y are ignored.
+
+    inputs:
+        df (df): tidy data with x_col, y_col, and group_cols
+        x_col, y_col (str): columns for the trend
+        group_cols (list): columns that identify each series
+
+    outputs:
+        df: group_cols, 'n', 'x mean', 'sxx', 'slope', 'intercept', and
+            'residual std' of each series
+    """
+    if isinstance(group_cols, str):
+        group_cols = [group_cols]
+    group_cols = list(group_cols)
+
+    data = df.dropna(subset=[x_col, y_col])
+    codes, groups = pd.factorize(
+        pd.MultiIndex.from_frame(data.loc[:, group_cols]), sort=True)
+    n_groups = len(groups)
+    x = data[x_col].values.astype(float)
+    y = data[y_col].values.astype(float)
+
+    def group_sum(values):
+        return np.bincount(codes, weights=values, minlength=n_groups)
+
+    n = np.bincount(codes, minlength=n_groups).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = group_sum(x) / n
+        y_mean = group_sum(y) / n
+        dx = x - x_mean[codes]
+        sxx = group_sum(dx ** 2)
+        slope = group_sum(dx * (y - y_mean[codes])) / sxx
+        intercept = y_mean - slope * x_mean
+
+        resid = y - (intercept[codes] + slope[codes] * x)
+        resid_std = np.sqrt(group_sum(resid ** 2) / (n - 2))
+
+    fits = groups.to_frame(index=False)
+    fits.columns = group_cols
+    fits['n'] = n.astype(int)
+    fits['x mean'] = x_mean
+    fits['sxx'] = sxx
+    fits['slope'] = slope
+    fits['intercept'] = intercept
+    fits['residual std'] = resid_std
+
+    return fits
+
+
+def trend_bands(df, x_col, y_col, group_cols, ci=95):
+    """
+    Fitted linear trend and confidence band of the mean (from the t
+    distribution) at the x value of every row of df. All series are
+    fit at once with linear_trends. This gives the line and band that
+    seaborn's regplot draws, without bootstrapping.
+
+    inputs:
+        df (df): tidy data with x_col, y_col, and group_cols
+        x_col, y_col (str): columns for the trend
+        group_cols (list): columns that identify each series
+        ci (float): size of the confidence interval (percent)
+
+    outputs:
+        df: 'trend', 'trend lower', and 'trend upper' with the same index
+            as df. Rows in groups with fewer than 3 points are NaN.
+    """
+    from scipy import stats
+
+    if isinstance(group_cols, str):
+        group_cols = [group_cols]
+    group_cols = list(group_cols)
+
+    fits = linear_trends(df, x_col, y_col, group_cols)
+    fit_index = pd.MultiIndex.from_frame(fits.loc[:, group_cols])
+    pos = fit_index.get_indexer(
+        pd.MultiIndex.from_frame(df.loc[:, group_cols]))
+    valid = pos >= 0
+    pos = np.where(valid, pos, 0)
+
+    def row_values(col):
+        values = fits[col].values.astype(float)[pos]
+        return np.where(valid, values, np.nan)
+
+    x = df[x_col].values.astype(float)
+    n = row_values('n')
+    trend = row_values('intercept') + row_values('slope') * x
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = stats.t.ppf(0.5 + ci / 200., n - 2)
+        half_width = (t * row_values('residual std')
+                      * np.sqrt(1 / n + (x - row_values('x mean')) ** 2
+                                / row_values('sxx')))
+
+    few_points = ~(n > 2)
+    trend[few_points] = np.nan
+    half_width[few_points] = np.nan
+
+    return pd.DataFrame({'trend': trend,
+                         'trend lower': trend - half_width,
+                         'trend upper': trend + half_width},
+                        index=df.index)
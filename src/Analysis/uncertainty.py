@@ -0,0 +1,345 @@
+# coding: utf-8
+
+import pandas as pd
+import numpy as np
+from Analysis.index import reduce_emission_factors
+
+
+def sample_emission_factors(ef, n_samples, rel_std=0.05, seed=None):
+    """
+    Draw emission factor samples for every fuel. Each sample multiplies the
+    fossil and total factors of a fuel by the same normally distributed
+    value (mean 1), truncated at 0.
+
+    inputs:
+        ef (df): emission factors with fuel codes as the index and columns
+            'Fossil Factor' and 'Total Factor'
+        n_samples (int): number of samples
+        rel_std (float, dict, or Series): relative standard deviation of the
+            factors, either one value for all fuels or a value for each fuel
+            code (fuels that aren't listed have no uncertainty)
+        seed (int): seed for the random number generator
+
+    outputs:
+        fossil, total (array): sampled factors, shape (n_samples, len(ef))
+    """
+    if isinstance(rel_std, (dict, pd.Series)):
+        rel_std = pd.Series(rel_std).reindex(ef.index).fillna(0).values
+
+    rng = np.random.RandomState(seed)
+    scale = 1 + rng.normal(size=(n_samples, len(ef))) * rel_std
+    scale = np.maximum(scale, 0)
+
+    fossil = ef['Fossil Factor'].values.astype(float) * scale
+    total = ef['Total Factor'].values.astype(float) * scale
+
+    return fossil, total
+
+
+def reduced_factor_matrix(ef, custom_reduce=None):
+    """
+    Linear map from fuel code emission factors to the reduced factors used
+    for state-level fuel types (e.g. PEL is the mean of DFO and RFO). Found
+    by passing one unit vector for each fuel through reduce_emission_factors.
+    A custom_reduce dict has constant factors, so it isn't used here.
+
+    outputs:
+        types (list): reduced fuel types (rows)
+        matrix (array): shape (len(types), len(ef))
+    """
+    columns = []
+    for i in range(len(ef)):
+        unit = ef.copy()
+        unit['Fossil Factor'] = np.eye(len(ef))[i]
+        columns.append(reduce_emission_factors(unit, custom_reduce))
+    types = list(columns[0].keys())
+    matrix = np.array([[col[t] for col in columns] for t in types])
+
+    return types, matrix
+
+
+def align_epa(pm_index, epa):
+    """
+    Align monthly EPA data to plant-months (the same rows as an inner merge
+    with EIA data in adjust_epa_emissions).
+
+    inputs:
+        pm_index (MultiIndex): ('plant id', 'year', 'month') for each row
+        epa (df): 'plant id', 'year', 'month', 'co2_mass (kg)', 'gload (mw)',
+            and 'heat_input (mmbtu)'
+
+    outputs:
+        epa_values (dict): column -> array aligned to pm_index (NaN where
+            there is no EPA data), including 'epa index'
+        has_epa (array): boolean array of plant-months with EPA data
+    """
+    epa_pos = pm_index.get_indexer(
+        pd.MultiIndex.from_frame(epa.loc[:, ['plant id', 'year', 'month']]))
+    found = epa_pos >= 0
+    has_epa = np.zeros(len(pm_index), dtype=bool)
+    has_epa[epa_pos[found]] = True
+
+    epa_values = {}
+    for col in ['co2_mass (kg)', 'gload (mw)', 'heat_input (mmbtu)']:
+        epa_values[col] = np.full(len(pm_index), np.nan)
+        epa_values[col][epa_pos[found]] = epa[col].values[found]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        epa_values['epa index'] = (epa_values['co2_mass (kg)']
+                                   / epa_values['gload (mw)'])
+
+    return epa_values, has_epa
+
+
+def region_group_matrix(plant_months, membership=None, region_types=None,
+                        keys=('year', 'month')):
+    """
+    Output rows and the sparse matrix that sums plant-months to them. Uses
+    RegionMembership.group_matrix, or national totals if membership is None.
+    """
+    from scipy import sparse
+
+    keys = list(keys)
+    if membership is not None:
+        return membership.group_matrix(plant_months, keys,
+                                       region_types=region_types)
+
+    codes, uniques = pd.factorize(
+        pd.MultiIndex.from_frame(plant_months.loc[:, keys]), sort=True)
+    groups = uniques.to_frame(index=False)
+    groups.columns = keys
+    groups.insert(0, 'region', 'USA')
+    groups.insert(0, 'region type', 'national')
+    matrix = sparse.csr_matrix(
+        (np.ones(len(plant_months)), (codes, np.arange(len(plant_months)))),
+        shape=(len(groups), len(plant_months)))
+
+    return groups, matrix
+
+
+def index_uncertainty(eia_facility, epa, ef, n_samples=1000, rel_std=0.05,
+                      membership=None, region_types=None,
+                      keys=('year', 'month'), extra_gen_fuel=None,
+                      percentiles=(2.5, 50, 97.5), batch_size=100, seed=None,
+                      return_samples=False):
+    """
+    Monte Carlo uncertainty of the index from emission factor uncertainty.
+    The EPA adjustment in facility_emission_gen (co2 ratio, zero/low index
+    checks, and EIA values where EPA data don't exist) is calculated for a
+    batch of emission factor samples at once, with fuel consumption as sparse
+    (plant-month x fuel) matrices and samples on the second axis. Regional
+    totals are a sparse product with the group matrix from a
+    RegionMembership, so no dataframe operations are repeated per sample.
+
+    inputs:
+        eia_facility (df): fuel-level facility data with 'plant id', 'year',
+            'month', 'fuel', 'total fuel (mmbtu)', 'elec fuel (mmbtu)', and
+            'generation (mwh)'
+        epa (df): monthly facility data with 'plant id', 'year', 'month',
+            'co2_mass (kg)', 'gload (mw)', and 'heat_input (mmbtu)'
+        ef (df): emission factors (see sample_emission_factors)
+        n_samples (int): number of emission factor samples
+        rel_std (float, dict, or Series): relative standard deviation of the
+            emission factors
+        membership (RegionMembership): regions to calculate. If None, only
+            national values are calculated.
+        region_types (list): only calculate these region sets
+        keys (list): time columns to keep separate, e.g. ('year', 'month')
+            or ('year',)
+        extra_gen_fuel (df): generation and fuel from non-reporting
+            facilities (extra_gen_fuel from extra_emissions_gen) with 'type',
+            'year', 'month', 'generation (mwh)', and 'elec fuel (mmbtu)'
+            columns. Added to national values.
+        percentiles (list): percentiles of the index to return
+        batch_size (int): number of samples calculated at once
+        seed (int): seed for the random number generator
+        return_samples (bool): also return the sampled index values
+
+    outputs:
+        df: 'region type', 'region', keys, 'generation (mwh)', the mean index
+            ('index (g/kwh)'), and a column for each percentile (e.g.
+            'index (g/kwh) p2.5')
+        samples (array): if return_samples, the index for each row of df and
+            each sample, shape (len(df), n_samples)
+    """
+    from scipy import sparse
+
+    keys = list(keys)
+
+    # One row per plant-month
+    pm_keys = ['plant id', 'year', 'month']
+    pm_codes, pm_index = pd.factorize(
+        pd.MultiIndex.from_frame(eia_facility.loc[:, pm_keys]), sort=True)
+    plant_months = pm_index.to_frame(index=False)
+    plant_months.columns = pm_keys
+    n_pm = len(plant_months)
+
+    # Sparse fuel consumption matrices (negative values count as 0, the same
+    # as negative co2 in data_extraction.facility_fuel_co2_from_ef)
+    fuel_codes = ef.index.get_indexer(eia_facility['fuel'])
+    has_factor = fuel_codes >= 0
+
+    def fuel_matrix(col):
+        values = np.nan_to_num(eia_facility[col].values.astype(float))
+        values = np.maximum(values, 0)[has_factor]
+        return sparse.csr_matrix((values, (pm_codes[has_factor],
+                                           fuel_codes[has_factor])),
+                                 shape=(n_pm, len(ef)))
+
+    total_fuel = fuel_matrix('total fuel (mmbtu)')
+    elec_fuel = fuel_matrix('elec fuel (mmbtu)')
+    gen = np.bincount(pm_codes, minlength=n_pm, weights=np.nan_to_num(
+        eia_facility['generation (mwh)'].values.astype(float)))
+
+    epa_values, has_epa = align_epa(pm_index, epa)
+    epa_co2 = epa_values['co2_mass (kg)'][:, None]
+    heat = epa_values['heat_input (mmbtu)'][:, None]
+    epa_index = epa_values['epa index'][:, None]
+
+    groups, group_matrix = region_group_matrix(plant_months, membership,
+                                               region_types, keys)
+    group_gen = group_matrix @ gen
+
+    # Extra generation and emissions are added to national rows
+    if extra_gen_fuel is not None:
+        extra = extra_gen_fuel.reset_index()
+        types, reduce_matrix = reduced_factor_matrix(ef)
+        type_codes = pd.Index(types).get_indexer(extra['type'])
+        national = np.flatnonzero(groups['region type'].values == 'national')
+        extra_rows = pd.MultiIndex.from_frame(
+            groups.loc[national, keys]).get_indexer(
+                pd.MultiIndex.from_frame(extra.loc[:, keys]))
+        use = (type_codes >= 0) & (extra_rows >= 0)
+        extra_fuel = sparse.csr_matrix(
+            (np.nan_to_num(extra['elec fuel (mmbtu)'].values[use]
+                           .astype(float)),
+             (national[extra_rows[use]], type_codes[use])),
+            shape=(len(groups), len(types)))
+        extra_gen = np.bincount(
+            national[extra_rows[extra_rows >= 0]], minlength=len(groups),
+            weights=np.nan_to_num(extra['generation (mwh)'].values
+                                  [extra_rows >= 0].astype(float)))
+        group_gen = group_gen + extra_gen
+
+    fossil, total = sample_emission_factors(ef, n_samples, rel_std, seed)
+
+    samples = np.empty((len(groups), n_samples))
+    for start in range(0, n_samples, batch_size):
+        batch = slice(start, start + batch_size)
+        ff, ft = fossil[batch].T, total[batch].T
+
+        # Calculated emissions for every plant-month and sample
+        elec_fossil = np.asarray(elec_fuel @ ff)
+        all_total = np.asarray(total_fuel @ ft)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = elec_fossil / all_total
+        ratio[np.isnan(ratio)] = 0
+
+        # Adjusted EPA emissions (see adjust_epa_emissions)
+        adj = epa_co2 * ratio
+        replace = (((~(epa_co2 > 0)) | (epa_index < 300))
+                   & (heat > 0) & (all_total > 0))
+        adj[replace] = np.nan
+
+        final = np.where(has_epa[:, None] & ~np.isnan(adj), adj, elec_fossil)
+        co2 = group_matrix @ final
+
+        if extra_gen_fuel is not None:
+            co2 = co2 + extra_fuel @ (reduce_matrix @ ff)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            samples[:, batch] = co2 / group_gen[:, None]
+
+    df = groups.copy()
+    df['generation (mwh)'] = group_gen
+    df['index (g/kwh)'] = samples.mean(axis=1)
+    bands = np.percentile(samples, percentiles, axis=1)
+    for q, band in zip(percentiles, bands):
+        df['index (g/kwh) p{:g}'.format(q)] = band
+
+    if return_samples:
+        return df, samples
+
+    return df
+
+
+def epa_threshold_sweep(eia_facility, epa, thresholds, membership=None,
+                        region_types=None, keys=('year', 'month'),
+                        zero_rule=True):
+    """
+    The index as a function of the low-index cutoff in adjust_epa_emissions
+    (300 g/kWh by default). EPA records with an epa index below the cutoff
+    (and heat input and calculated co2 > 0) are replaced by calculated EIA
+    emissions. Rather than re-running the adjustment for every threshold, the
+    change in emissions for each facility-month is binned by the first
+    threshold where it applies and summed with a cumulative sum over the
+    sorted thresholds.
+
+    inputs:
+        eia_facility (df): fuel-level facility data with co2 columns (the
+            input to group_facility_data)
+        epa (df): monthly facility data with 'plant id', 'year', 'month',
+            'co2_mass (kg)', 'gload (mw)', and 'heat_input (mmbtu)'
+        thresholds (list): cutoff values (g/kWh) to evaluate
+        membership (RegionMembership): regions to calculate. If None, only
+            national values are calculated.
+        region_types (list): only calculate these region sets
+        keys (list): time columns to keep separate, e.g. ('year', 'month')
+            or ('year',)
+        zero_rule (bool): also replace EPA records with 0 co2 but positive
+            heat input (as in adjust_epa_emissions)
+
+    outputs:
+        df: 'region type', 'region', keys, 'threshold', 'generation (mwh)',
+            'final co2 (kg)', and 'index (g/kwh)'
+    """
+    from scipy import sparse
+    from Analysis.index import group_facility_data
+
+    keys = list(keys)
+    thresholds = np.unique(np.asarray(thresholds, dtype=float))
+
+    grouped = group_facility_data(eia_facility)
+    plant_months = grouped.loc[:, ['plant id', 'year', 'month']]
+    pm_index = pd.MultiIndex.from_frame(plant_months)
+    epa_values, has_epa = align_epa(pm_index, epa)
+
+    elec_fossil = grouped['elec fuel fossil co2 (kg)'].values
+    all_total = grouped['all fuel total co2 (kg)'].values
+    ratio = grouped['co2 ratio'].fillna(0).values
+
+    eligible = (has_epa & (epa_values['heat_input (mmbtu)'] > 0)
+                & (all_total > 0))
+    adj = epa_values['co2_mass (kg)'] * ratio
+    if zero_rule:
+        adj[eligible & ~(epa_values['co2_mass (kg)'] > 0)] = np.nan
+
+    # Final co2 with no low-index cutoff
+    valid = has_epa & ~np.isnan(adj)
+    base = np.where(valid, adj, elec_fossil)
+
+    # Change in co2 when a record falls below the cutoff, binned by the index
+    # of the first threshold above its epa index
+    switch = np.flatnonzero(eligible & valid)
+    bins = np.searchsorted(thresholds, epa_values['epa index'][switch],
+                           side='right')
+    in_range = bins < len(thresholds)
+    switch, bins = switch[in_range], bins[in_range]
+    delta = sparse.csr_matrix(
+        (elec_fossil[switch] - adj[switch], (switch, bins)),
+        shape=(len(grouped), len(thresholds)))
+
+    groups, group_matrix = region_group_matrix(plant_months, membership,
+                                               region_types, keys)
+    gen = group_matrix @ grouped['generation (mwh)'].values
+    co2 = ((group_matrix @ base)[:, None]
+           + np.cumsum((group_matrix @ delta).toarray(), axis=1))
+
+    df = groups.loc[np.repeat(np.arange(len(groups)), len(thresholds))]
+    df = df.reset_index(drop=True)
+    df['threshold'] = np.tile(thresholds, len(groups))
+    df['generation (mwh)'] = np.repeat(gen, len(thresholds))
+    df['final co2 (kg)'] = co2.ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['index (g/kwh)'] = df['final co2 (kg)'] / df['generation (mwh)']
+
+    return df
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import mmap
+import hashlib
+import pandas as pd
+import numpy as np
+from util.utils import get_cache_path
+
+SERIES_ID_RE = re.compile(rb'"series_id"\s*:\s*"([^"]*)"')
+LAST_UPDATED_RE = re.compile(rb'"last_updated"\s*:\s*"([^"]*)"')
+GEOGRAPHY_RE = re.compile(rb'"geography"\s*:\s*"([^"]*)"')
+
+
+def _index_cache_path(path):
+    'Cache file for a bulk file index, keyed by path, size and mtime'
+    stat = os.stat(path)
+    key = '{}|{}|{}'.format(os.path.abspath(path), stat.st_size,
+                            stat.st_mtime)
+    key = hashlib.md5(key.encode()).hexdigest()
+
+    return get_cache_path('elec_index_{}.feather'.format(key))
+
+
+def series_category(series_id):
+    """
+    Category of a series id, which is everything except the last two parts.
+    e.g. ELEC.PLANT.GEN.388-WAT-ALL.M -> ELEC.PLANT.GEN
+    """
+    return '.'.join(series_id.split('.')[:-2])
+
+
+def build_series_index(path, cache=True):
+    """
+    Scan an EIA bulk file (e.g. ELEC.txt) once and record the location of
+    every series. Only the series_id, last_updated, and geography fields are
+    read from each line (with regular expressions), so no JSON is decoded.
+    The index is saved in the cache folder and reused until the file changes.
+
+    inputs:
+        path (str): path to the bulk file
+        cache (bool): load/save the index from the cache folder
+
+    outputs:
+        df: one row per series with columns 'series_id', 'offset' (byte
+            offset of the line), 'length' (bytes), 'last_updated',
+            'geography', 'category', and 'hash' (md5 of the line)
+    """
+    cache_path = _index_cache_path(path)
+    if cache and os.path.exists(cache_path):
+        return pd.read_feather(cache_path)
+
+    series_ids, offsets, lengths = [], [], []
+    last_updated, geography, hashes = [], [], []
+
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            match = SERIES_ID_RE.search(line)
+            if match:
+                series_ids.append(match.group(1).decode())
+                offsets.append(offset)
+                lengths.append(len(line))
+
+                updated = LAST_UPDATED_RE.search(line)
+                last_updated.append(updated.group(1).decode()
+                                    if updated else None)
+                geo = GEOGRAPHY_RE.search(line)
+                geography.append(geo.group(1).decode() if geo else None)
+                hashes.append(hashlib.md5(line).hexdigest())
+            offset += len(line)
+
+    index = pd.DataFrame({'series_id': series_ids,
+                          'offset': np.array(offsets, dtype=np.int64),
+                          'length': np.array(lengths, dtype=np.int64),
+                          'last_updated': last_updated,
+                          'geography': geography,
+                          'hash': hashes})
+    index['category'] = index['series_id'].map(series_category)
+    index = index.loc[:, ['series_id', 'offset', 'length', 'last_updated',
+                          'geography', 'category', 'hash']]
+
+    if cache:
+        index.to_feather(cache_path)
+
+    return index
+
+
+def select_series(index, series_ids=None, category=None, geography=None,
+                  frequency=None):
+    """
+    Filter a series index. Each argument can be a single value or a list.
+    frequency is the last part of the series id (e.g. 'M' or 'A').
+    """
+    mask = np.ones(len(index), dtype=bool)
+    for col, values in [('series_id', series_ids), ('category', category),
+                        ('geography', geography)]:
+        if values is None:
+            continue
+        if isinstance(values, str):
+            values = [values]
+        mask &= index[col].isin(values).values
+    if frequency is not None:
+        mask &= index['series_id'].str.endswith('.' + frequency).values
+
+    return index.loc[mask]
+
+
+def read_series_lines(path, index_rows):
+    """
+    Read and decode only the lines listed in index_rows (rows of a series
+    index) by memory-mapping the bulk file.
+
+    outputs:
+        list of dicts, one per series (in file order)
+    """
+    index_rows = index_rows.sort_values('offset')
+    lines = []
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset, length in zip(index_rows['offset'].values,
+                                      index_rows['length'].values):
+                lines.append(json.loads(mm[offset:offset + length]))
+
+    return lines
+
+
+def series_to_df(lines, keep_keys=('series_id', 'geography', 'units',
+                                   'last_updated', 'lat', 'lon')):
+    """
+    Build a long dataframe from a list of series dicts. Values from every
+    series are collected into flat lists and converted to columns once,
+    rather than creating a dataframe for each series. Monthly (YYYYMM) and
+    quarterly (YYYYQn) periods are split into integer 'year' and 'month' or
+    'quarter' columns. The 'month' and 'quarter' columns are only added if
+    there are periods of that frequency, and are 0 on other rows (e.g.
+    annual periods, YYYY).
+
+    inputs:
+        lines (list): decoded series (dicts with a 'data' key)
+        keep_keys (list): metadata keys to repeat on every row
+
+    outputs:
+        df: columns from keep_keys plus 'year', 'month', 'quarter', and
+            'value'
+    """
+    periods, values, counts = [], [], []
+    meta = {key: [] for key in keep_keys}
+    for line in lines:
+        data = line.get('data', [])
+        counts.append(len(data))
+        for period, value in data:
+            periods.append(period)
+            values.append(value)
+        for key in keep_keys:
+            meta[key].append(line.get(key))
+
+    counts = np.array(counts, dtype=np.int64)
+    df = pd.DataFrame({key: np.repeat(np.array(vals, dtype=object), counts)
+                       for key, vals in meta.items()})
+
+    periods = np.array(periods, dtype=str)
+    length = np.char.str_len(periods)
+    is_annual = (length == 4) & np.char.isdigit(periods)
+    is_monthly = (length == 6) & np.char.isdigit(periods)
+    is_quarterly = (length == 6) & (np.char.find(periods, 'Q') == 4)
+    unknown = ~(is_annual | is_monthly | is_quarterly)
+    if unknown.any():
+        raise ValueError('Unrecognized periods (e.g. {}). Only annual, '
+                         'quarterly, and monthly series can be '
+                         'read'.format(periods[unknown][0]))
+
+    # 'YYYYQn' -> YYYY0n, so month and quarter are both the last two digits
+    if is_quarterly.any():
+        periods = np.char.replace(periods, 'Q', '0')
+    period_int = periods.astype(np.int64)
+    df['year'] = np.where(is_annual, period_int, period_int // 100)
+    if is_monthly.any():
+        df['month'] = np.where(is_monthly, period_int % 100, 0)
+    if is_quarterly.any():
+        df['quarter'] = np.where(is_quarterly, period_int % 100, 0)
+    df['value'] = pd.to_numeric(pd.Series(values, dtype=object),
+                                errors='coerce').values
+
+    return df
+
+
+def get_series(path, series_ids=None, category=None, geography=None,
+               frequency=None, index=None):
+    """
+    Look up series in an EIA bulk file by id, category, and/or geography
+    without scanning the file. The series index is built (or loaded from the
+    cache) if it isn't passed in.
+
+    example:
+        get_series(path, category='ELEC.PLANT.GEN', geography='USA-AL',
+                   frequency='M')
+
+    outputs:
+        df: long dataframe from series_to_df
+    """
+    if index is None:
+        index = build_series_index(path)
+    rows = select_series(index, series_ids=series_ids, category=category,
+                         geography=geography, frequency=frequency)
+
+    return series_to_df(read_series_lines(path, rows))
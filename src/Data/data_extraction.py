@@ -1,5 +1,7 @@
 import pandas as pd
+import numpy as np
 import os
+from util.time_axis import date_hour_to_datetime
 
 def import_clean_epa(path, name, col_name_map):
     fullpath = os.path.join(path, name)
@@ -9,9 +11,8 @@ def import_clean_epa(path, name, col_name_map):
 
     # Rather than just converting the date column to datetime, create a new column
     # that also makes use of the operating hour
-    df_temp.loc[:,'OP_DATE_TIME'] = pd.to_datetime(df_temp['OP_DATE'] +
-                                                   '-' +
-                                                   df_temp['OP_HOUR'].astype(str), format='%m-%d-%Y-%H')
+    df_temp.loc[:,'OP_DATE_TIME'] = date_hour_to_datetime(df_temp['OP_DATE'],
+                                                          df_temp['OP_HOUR'])
 #    df_temp.loc[:,'OP_DATE'] = pd.to_datetime(df_temp.loc[:,'OP_DATE'], format='%m-%d-%Y')
     return df_temp
 
@@ -94,3 +95,358 @@ def facility_line_to_df(line):
     except:
         exception_list.append(line)
         pass
+
+# Facility series in the EIA bulk file and the column name for each
+FACILITY_CATEGORIES = {'ELEC.PLANT.GEN': 'generation (MWh)',
+                       'ELEC.PLANT.CONS_TOT_BTU': 'total fuel (mmbtu)',
+                       'ELEC.PLANT.CONS_EG_BTU': 'elec fuel (mmbtu)'}
+
+def is_facility_series(series_id, category):
+    'Monthly facility generation or fuel consumption for all prime movers'
+    return (category in FACILITY_CATEGORIES
+            and series_id.endswith('ALL.M')
+            and 'ALL-' not in series_id)
+
+def facility_series(index):
+    """
+    Filter a bulk file series index (from Data.bulk_index) to the monthly
+    facility generation and fuel consumption series for all prime movers
+    (is_facility_series), and add 'plant id' and 'fuel' columns parsed from
+    the series id.
+    """
+    mask = np.array([is_facility_series(series_id, category)
+                     for series_id, category
+                     in zip(index['series_id'], index['category'])],
+                    dtype=bool)
+    fac_index = index.loc[mask].copy()
+
+    # Example: ELEC.PLANT.GEN.388-WAT-ALL.M
+    plant_fuel_mover = (fac_index['series_id'].str.split('.').str[-2]
+                                             .str.split('-'))
+    fac_index['plant id'] = plant_fuel_mover.str[0].astype(int)
+    fac_index['fuel'] = plant_fuel_mover.str[1]
+
+    return fac_index
+
+def facility_series_to_df(lines):
+    """
+    Convert decoded facility series (dicts) to a long dataframe with plant id,
+    fuel, prime mover, and the measure column name for each row.
+    """
+    from Data.bulk_index import series_to_df, series_category
+
+    df = series_to_df(lines)
+    plant_fuel_mover = df['series_id'].str.split('.').str[-2].str.split('-')
+    df['plant id'] = plant_fuel_mover.str[0].astype(int)
+    df['fuel'] = plant_fuel_mover.str[1]
+    df['prime mover'] = plant_fuel_mover.str[2]
+    df['measure'] = (df['series_id'].map(series_category)
+                                    .map(FACILITY_CATEGORIES))
+    df['lat'] = df['lat'].astype(float)
+    df['lon'] = df['lon'].astype(float)
+
+    return df
+
+def combine_facility_data(long_df):
+    """
+    Combine long generation, total fuel, and elec fuel data into a single
+    facility dataframe with one row per plant, fuel, year, and month.
+
+    The long rows are pivoted once on the measure label rather than merged
+    measure by measure. Metadata (prime mover, geography, lat/lon,
+    last_updated) come from the first series that has them, in the order
+    total fuel, generation, elec fuel (the same as the merges in the
+    extract facility generation notebook).
+    """
+    key_cols = ['fuel', 'month', 'plant id', 'year']
+    meta_cols = ['prime mover', 'geography', 'lat', 'lon', 'last_updated']
+    measures = list(FACILITY_CATEGORIES.values())
+    meta_order = ['total fuel (mmbtu)', 'generation (MWh)',
+                  'elec fuel (mmbtu)']
+
+    long_df = long_df.loc[long_df['measure'].isin(measures)]
+    rank = pd.Categorical(long_df['measure'], categories=meta_order).codes
+    long_df = long_df.iloc[np.argsort(rank, kind='mergesort')]
+
+    grouped = long_df.groupby(key_cols)
+    values = (long_df.groupby(key_cols + ['measure'])['value']
+                     .first()
+                     .unstack('measure')
+                     .reindex(columns=measures))
+    values.columns.name = None
+    meta = grouped[meta_cols].first()
+
+    df = pd.concat([values, meta], axis=1)
+    df.reset_index(inplace=True)
+
+    return df
+
+def facility_fuel_co2_from_ef(df, ef):
+    """
+    Calculate fossil and total CO2 emissions from all fuel and elec fuel
+    consumption at each facility using emission factors. Negative or missing
+    values are set to 0. (Analysis.index.facility_co2 is different: it
+    combines these EIA values with adjusted EPA emissions.)
+
+    inputs:
+        df (df): facility data with 'fuel', 'total fuel (mmbtu)', and
+            'elec fuel (mmbtu)' columns
+        ef (df): emission factors with fuel codes as the index and columns
+            'Fossil Factor' and 'Total Factor'
+    """
+    fossil = df['fuel'].map(ef['Fossil Factor'])
+    total = df['fuel'].map(ef['Total Factor'])
+
+    emissions = {'all fuel fossil CO2 (kg)': df['total fuel (mmbtu)'] * fossil,
+                 'all fuel total CO2 (kg)': df['total fuel (mmbtu)'] * total,
+                 'elec fuel fossil CO2 (kg)': df['elec fuel (mmbtu)'] * fossil,
+                 'elec fuel total CO2 (kg)': df['elec fuel (mmbtu)'] * total}
+    for col, values in emissions.items():
+        df[col] = values.where(values >= 0, 0)
+
+def extract_facility_data(path, ef=None, index=None, plant_fuels=None):
+    """
+    Extract monthly facility generation and fuel consumption from an EIA bulk
+    file (ELEC.txt) using the series index, so only facility lines are read.
+
+    inputs:
+        path (str): path to the bulk file
+        ef (df): emission factors. If given, add CO2 emission columns.
+        index (df): series index of the bulk file (built if None)
+        plant_fuels (df): optional 'plant id' and 'fuel' pairs to extract
+
+    outputs:
+        df: facility data in the same format as the "Facility gen fuels and
+            CO2" file
+    """
+    from Data.bulk_index import build_series_index, read_series_lines
+    from Analysis.index import add_quarter
+
+    if index is None:
+        index = build_series_index(path)
+    fac_index = facility_series(index)
+    if plant_fuels is not None:
+        fac_index = fac_index.merge(plant_fuels.loc[:, ['plant id', 'fuel']]
+                                               .drop_duplicates(),
+                                    on=['plant id', 'fuel'])
+
+    long_df = facility_series_to_df(read_series_lines(path, fac_index))
+    df = combine_facility_data(long_df)
+    add_quarter(df)
+    if ef is not None:
+        facility_fuel_co2_from_ef(df, ef)
+
+    return df
+
+def changed_series(old_index, new_index):
+    """
+    Compare the series indexes of two bulk file releases.
+
+    outputs:
+        df: series ids that were added, removed, or changed (different
+            last_updated or line hash), with a 'status' column
+    """
+    cols = ['series_id', 'last_updated', 'hash']
+    df = new_index.loc[:, cols].merge(old_index.loc[:, cols], on='series_id',
+                                      how='outer', suffixes=('', '_old'),
+                                      indicator=True)
+    df['status'] = df['_merge'].map({'left_only': 'added',
+                                     'right_only': 'removed',
+                                     'both': 'changed'}).astype(str)
+    changed = ((df['last_updated'] != df['last_updated_old'])
+               | (df['hash'] != df['hash_old']))
+    df = df.loc[(df['status'] != 'changed') | changed,
+                ['series_id', 'status']]
+
+    return df.reset_index(drop=True)
+
+def update_facility_data(facility_df, path, old_index, new_index=None,
+                         ef=None):
+    """
+    Update a facility dataframe extracted from a previous bulk file release
+    with a new release. Only the plant/fuel combinations with a series that
+    was added, removed, or changed are re-extracted from the new file.
+
+    inputs:
+        facility_df (df): facility data from the previous release
+        path (str): path to the new bulk file
+        old_index (df): series index of the previous bulk file
+        new_index (df): series index of the new bulk file (built if None)
+        ef (df): emission factors used to calculate CO2. Required if
+            facility_df has CO2 columns.
+
+    outputs:
+        df: updated facility data
+    """
+    from Data.bulk_index import build_series_index
+
+    co2_cols = [col for col in facility_df.columns if 'co2' in col.lower()]
+    if co2_cols and ef is None:
+        raise ValueError('facility_df has CO2 columns ({}), so emission '
+                         'factors (ef) are needed to calculate CO2 for the '
+                         'updated rows'.format(', '.join(co2_cols)))
+
+    if new_index is None:
+        new_index = build_series_index(path)
+
+    changes = changed_series(facility_series(old_index),
+                             facility_series(new_index))
+    if changes.empty:
+        return facility_df
+
+    plant_fuel_mover = (changes['series_id'].str.split('.').str[-2]
+                                            .str.split('-'))
+    plant_fuels = pd.DataFrame({'plant id': plant_fuel_mover.str[0].astype(int),
+                                'fuel': plant_fuel_mover.str[1]})
+    plant_fuels.drop_duplicates(inplace=True)
+
+    new_rows = extract_facility_data(path, ef=ef, index=new_index,
+                                     plant_fuels=plant_fuels)
+
+    # Drop all rows for plant/fuel combinations that changed
+    keys = pd.MultiIndex.from_frame(plant_fuels)
+    old_keys = pd.MultiIndex.from_frame(facility_df.loc[:, ['plant id',
+                                                            'fuel']])
+    unchanged = facility_df.loc[~old_keys.isin(keys)]
+
+    df = pd.concat([unchanged, new_rows], ignore_index=True, sort=False)
+    df = df.loc[:, facility_df.columns]
+
+    return df
+
+# State-level (and national) series in the EIA bulk file
+STATE_CATEGORIES = {'ELEC.GEN': 'generation (MWh)',
+                    'ELEC.CONS_TOT_BTU': 'total fuel (mmbtu)',
+                    'ELEC.CONS_EG_BTU': 'elec fuel (mmbtu)'}
+
+# State-level data are in thousand MWh and billion Btu
+STATE_UNITS = {'generation (MWh)': (1000, 'megawatthours'),
+               'total fuel (mmbtu)': (1e6, 'mmbtu'),
+               'elec fuel (mmbtu)': (1e6, 'mmbtu')}
+
+STATES = ["AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE",
+          "FL", "GA", "HI", "ID", "IL", "IN", "IA", "KS",
+          "KY", "LA", "ME", "MD", "MA", "MI", "MN", "MS",
+          "MO", "MT", "NE", "NV", "NH", "NJ", "NM", "NY",
+          "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC",
+          "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"]
+
+def is_state_series(series_id, category):
+    'Monthly state or national totals for a single fuel type (all sectors)'
+    return (category in STATE_CATEGORIES
+            and series_id.endswith('-99.M')
+            and 'ALL' not in series_id)
+
+def state_series_to_df(lines):
+    """
+    Convert decoded state-level series (dicts) to a long dataframe with fuel
+    type, sector, measure column name, and values in MWh or mmbtu.
+    """
+    from Data.bulk_index import series_to_df, series_category
+
+    df = series_to_df(lines, keep_keys=('series_id', 'geography',
+                                        'last_updated'))
+
+    # Example: ELEC.GEN.COW-AL-99.M
+    type_geo_sector = df['series_id'].str.split('.').str[-2].str.split('-')
+    df['type'] = type_geo_sector.str[0]
+    df['sector'] = type_geo_sector.str[2]
+    df['measure'] = (df['series_id'].map(series_category)
+                                    .map(STATE_CATEGORIES))
+
+    df['units'] = None
+    for measure, (factor, units) in STATE_UNITS.items():
+        mask = df['measure'] == measure
+        df.loc[mask, 'value'] *= factor
+        df.loc[mask, 'units'] = units
+
+    return df
+
+def combine_state_data(long_df, ef=None):
+    """
+    Combine long state-level generation, total fuel, and elec fuel data into
+    one row per geography, fuel type, year, and month. If emission factors
+    are given, add CO2 emissions using the reduced state-level factors.
+    """
+    from Analysis.index import reduce_emission_factors
+
+    keys = ['type', 'year', 'month', 'geography']
+    df = long_df.pivot_table(index=keys, columns='measure', values='value',
+                             aggfunc='sum')
+    df.columns.name = None
+    df = df.reindex(columns=list(STATE_CATEGORIES.values()))
+    # Missing generation is 0 (the same as the state-level notebook)
+    df['generation (MWh)'] = df['generation (MWh)'].fillna(0)
+    df['last_updated'] = long_df.groupby(keys)['last_updated'].max()
+
+    if ef is not None:
+        fuel_factors = pd.Series(reduce_emission_factors(ef))
+        factors = (df.index.get_level_values('type').map(fuel_factors)
+                           .fillna(0).values)
+        df['all fuel CO2 (kg)'] = df['total fuel (mmbtu)'].fillna(0) * factors
+        df['elec fuel CO2 (kg)'] = df['elec fuel (mmbtu)'].fillna(0) * factors
+
+    return df.reset_index()
+
+def extract_bulk_data(path, states=None, national=False, ef=None):
+    """
+    Extract facility and state-level (and national) monthly generation and
+    fuel consumption from an EIA bulk file in a single streaming pass. Each
+    line is routed using only its series_id and geography, so JSON is only
+    decoded for lines that are kept.
+
+    inputs:
+        path (str): path to the bulk file (ELEC.txt)
+        states (list): 2-letter state codes to keep. Defaults to all states.
+        national (bool): also return national totals (geography 'USA') as
+            a separate dataframe
+        ef (df): emission factors. If given, add CO2 emission columns to all
+            dataframes.
+
+    outputs:
+        facility_df (df): facility data (same format as extract_facility_data)
+        state_df (df): state data
+        national_df (df): national data, only returned if national is True.
+            National rows are kept out of state_df so that sums over
+            geography don't double count.
+    """
+    import json
+    from Data.bulk_index import SERIES_ID_RE, GEOGRAPHY_RE, series_category
+    from Analysis.index import add_quarter
+
+    geos = {'USA-{}'.format(state) for state in (states or STATES)}
+    if national:
+        geos.add('USA')
+    geos = {geo.encode() for geo in geos}
+
+    facility_lines, state_lines = [], []
+    with open(path, 'rb') as f:
+        for line in f:
+            match = SERIES_ID_RE.search(line)
+            if not match:
+                continue
+            series_id = match.group(1).decode()
+            category = series_category(series_id)
+
+            if is_facility_series(series_id, category):
+                facility_lines.append(json.loads(line))
+            elif is_state_series(series_id, category):
+                geo = GEOGRAPHY_RE.search(line)
+                if geo and geo.group(1) in geos:
+                    state_lines.append(json.loads(line))
+
+    facility_df = combine_facility_data(facility_series_to_df(facility_lines))
+    add_quarter(facility_df)
+    if ef is not None:
+        facility_fuel_co2_from_ef(facility_df, ef)
+
+    state_df = combine_state_data(state_series_to_df(state_lines), ef=ef)
+    add_quarter(state_df)
+
+    if national:
+        is_usa = (state_df['geography'] == 'USA').values
+        national_df = state_df.loc[is_usa].reset_index(drop=True)
+        state_df = state_df.loc[~is_usa].reset_index(drop=True)
+        return facility_df, state_df, national_df
+
+    return facility_df, state_df
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import zipfile
+import hashlib
+import warnings
+import pandas as pd
+from util.utils import file_hash, get_cache_path
+
+
+def normalize_header(col):
+    """
+    Column names in EIA documents can have line breaks and extra spaces.
+    Make them lowercase and single-spaced.
+    """
+    return ' '.join(str(col).lower().replace('\n', ' ').split())
+
+
+def read_eia_excel(path, sheet_name, usecols=None, header=0, member=None,
+                   skipfooter=0, cache=True):
+    """
+    Read a single sheet from an EIA Excel workbook (e.g. EIA-923, EIA-860,
+    EIA-860m). The workbook can be a file on disk or a member of a zip file,
+    which is read directly from the archive without extracting it. Headers
+    are normalized with normalize_header. The result is cached as a feather
+    file keyed by a hash of the workbook (or zip) and the read arguments, so
+    repeat reads skip Excel parsing entirely.
+
+    inputs:
+        path (str): path to an .xlsx/.xls file or a .zip file
+        sheet_name (str): name of the sheet to read
+        usecols (list or str): normalized column names to keep, or an Excel
+            column range string (e.g. 'B,J') passed directly to pandas. If
+            None, read all columns.
+        header (int): row number of the header
+        member (str): if path is a zip file, a substring that uniquely
+            identifies the workbook inside the zip (e.g. '_Schedules_2')
+        skipfooter (int): number of rows to skip at the end of the sheet
+        cache (bool): load/save the parsed sheet from the cache folder
+
+    outputs:
+        df: dataframe with normalized column names
+    """
+    key = '|'.join(str(x) for x in [file_hash(path), member, sheet_name,
+                                     usecols, header, skipfooter])
+    key = hashlib.md5(key.encode()).hexdigest()
+    cache_path = get_cache_path('excel_{}.feather'.format(key))
+
+    if cache and os.path.exists(cache_path):
+        return pd.read_feather(cache_path)
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z_file:
+            names = [x for x in z_file.namelist()
+                     if member is None or member in x]
+            names = [x for x in names if x.lower().endswith(('.xls', '.xlsx'))]
+            if len(names) != 1:
+                raise ValueError('Expected one workbook matching {} in {}, '
+                                 'found {}'.format(member, path, names))
+            io_ = io.BytesIO(z_file.read(names[0]))
+    else:
+        io_ = path
+
+    # Only parse the columns that are needed
+    if isinstance(usecols, (list, tuple, set)):
+        keep = set(usecols)
+        read_cols = lambda col: normalize_header(col) in keep
+    else:
+        read_cols = usecols
+
+    df = pd.read_excel(io_, sheet_name=sheet_name, header=header,
+                       usecols=read_cols, skipfooter=skipfooter)
+    df.columns = [normalize_header(col) for col in df.columns]
+
+    if cache:
+        try:
+            df.reset_index(drop=True).to_feather(cache_path)
+        except Exception as e:
+            # Mixed-type object columns can't be written to feather
+            warnings.warn('Could not cache {}: {}'.format(sheet_name, e))
+
+    return df
@@ -4,6 +4,7 @@ import os
 from os.path import join, abspath, normpath, dirname, split
 import pandas as pd
 from util.utils import getParentDir
+from Data.eia_excel import read_eia_excel
 import sys
 PY3 = sys.version_info.major == 3
 
@@ -24,14 +25,11 @@ def get_annual_plants(year,
         annual_id: a Pandas Series with plant ids
     """
     import glob
-    import zipfile
     if PY3:
         from urllib.request import urlretrieve
     else:
         from urllib import urlretrieve
 
-    unzip_path = None
-
     # Get the project top-level path
     ap = abspath(__file__)
     top_path = getParentDir(dirname(ap), level=2)
@@ -49,24 +47,11 @@ def get_annual_plants(year,
         url = website + 'xls/{}'.format(fname)
         urlretrieve(url, filename=save_path)
 
-    # See if the unzipped folder exists. If not, unzip the file
-    unzip_path = join(path, fname.split('.')[0])
-    #print(save_path)
-    z_file = zipfile.ZipFile(save_path)
-    z_names = z_file.namelist()
-    if not os.path.exists(unzip_path):
-        # Extract the zipfile into new folder
-        z_file.extractall(unzip_path)
-
-    # Read the sheet "Page 6 Plant Frame" from the appropriate file.
-    # year_fn = glob.glob(join(unzip_path, '*Schedules_2*'))[0]
-    # Use the z_names variable, which is a list of file names in the zipfile
-    year_fn = [x for x in z_names if '_Schedules_2' in x][0]
-    read_path = join(unzip_path, year_fn)
-    df = pd.read_excel(read_path, sheet_name='Page 6 Plant Frame', header=4)
-
-    # Column names in EIA documents can have line breaks and extra spaces
-    df.columns = [col.lower().replace('\n', ' ').strip() for col in df.columns]
+    # Read the sheet "Page 6 Plant Frame" directly from the zip file. Only the
+    # two columns that are needed are parsed, and the result is cached.
+    df = read_eia_excel(save_path, sheet_name='Page 6 Plant Frame', header=4,
+                        usecols=['plant id', 'reporting frequency'],
+                        member='_Schedules_2')
 
     # Get the plant ids for just plants that report annually
     annual_plants = df.loc[df['reporting frequency'] == 'A', 'plant id']
@@ -75,45 +60,169 @@ def get_annual_plants(year,
 
     return annual_plants
 
-def states_in_nerc():
+def shapefile_paths():
+    'Default paths of the NERC and state shapefiles'
+    ap = abspath(__file__)
+    top_path = getParentDir(dirname(ap), level=2)
+
+    nerc_path = join(top_path, 'Data storage', 'NERC_Regions_EIA',
+                     'NercRegions_201610.shp')
+    state_path = join(top_path, 'Data storage', 'cb_2016_us_state_500k',
+                      'cb_2016_us_state_500k.shp')
+
+    return nerc_path, state_path
+
+def state_nerc_overlap(nerc_path=None, state_path=None, plants=None,
+                       weight_col=None, tolerance=1000, crs='EPSG:5070',
+                       cache=True):
+    """
+    Fraction of each state in each NERC region. Area fractions are
+    calculated from simplified polygons in an equal-area projection, and
+    only state/region pairs found by a spatial index query are intersected.
+    The area matrix is cached, keyed by hashes of the shapefiles (geometry
+    and attributes) and the simplification settings, so the intersection
+    only runs once for each version of the shapefiles.
+
+    inputs:
+        nerc_path (str): NERC region shapefile. Defaults to the EIA 2016
+            regions in 'Data storage'.
+        state_path (str): state shapefile. Defaults to the 2016 census 500k
+            states in 'Data storage'.
+        plants (df): optional facility data with 'plant id', 'state' and
+            'nerc' columns. If given, states with plants use the fraction of
+            plants (or of weight_col) in each region instead of the area
+            fraction. Only the last row for each plant is used (the most
+            recent year if there is a year column). Plants in regions that
+            aren't in the NERC shapefile are ignored, and states without
+            any weight in the shapefile regions keep the area fraction.
+        weight_col (str): column in plants to weight by (e.g. capacity or
+            generation). Each plant counts once if None.
+        tolerance (float): simplification tolerance in units of crs (meters)
+        crs (str): equal-area projection used for areas
+        cache (bool): load/save the area matrix from the cache folder
+
+    outputs:
+        df: states x NERC regions dataframe of fractions (index 'state').
+            Rows sum to 1 for states that are entirely within the regions.
+    """
+    import hashlib
+    from util.utils import file_hash, get_cache_path
+
+    default_nerc, default_state = shapefile_paths()
+    nerc_path = nerc_path or default_nerc
+    state_path = state_path or default_state
+
+    # Geometry is in the .shp file and region/state names in the .dbf file
+    hashes = [file_hash(os.path.splitext(path)[0] + ext)
+              for path in (nerc_path, state_path)
+              for ext in ('.shp', '.dbf')]
+    key = '|'.join(hashes + [str(tolerance), str(crs)])
+    key = hashlib.md5(key.encode()).hexdigest()
+    cache_path = get_cache_path('state_nerc_overlap_{}.feather'.format(key))
+
+    if cache and os.path.exists(cache_path):
+        overlap = pd.read_feather(cache_path).set_index('state')
+    else:
+        overlap = state_nerc_area_fractions(nerc_path, state_path,
+                                            tolerance, crs)
+        if cache:
+            overlap.reset_index().to_feather(cache_path)
+
+    if plants is not None:
+        if 'year' in plants.columns:
+            plants = plants.sort_values('year')
+        plants = plants.drop_duplicates(subset='plant id', keep='last')
+        weights = (plants[weight_col] if weight_col
+                   else pd.Series(1.0, index=plants.index))
+        plant_frac = pd.crosstab(plants['state'], plants['nerc'],
+                                 values=weights, aggfunc='sum').fillna(0)
+        # Regions that aren't in the shapefile are dropped before the
+        # fractions are calculated, so rows still sum to 1. States with a
+        # total weight of 0 keep the area fraction.
+        plant_frac = plant_frac.reindex(columns=overlap.columns, fill_value=0)
+        total = plant_frac.sum(axis=1)
+        plant_frac = plant_frac.loc[total > 0].div(total[total > 0], axis=0)
+        has_plants = overlap.index.intersection(plant_frac.index)
+        overlap = overlap.copy()
+        overlap.loc[has_plants] = plant_frac.loc[has_plants].values
+
+    return overlap
+
+def state_nerc_area_fractions(nerc_path, state_path, tolerance=1000,
+                              crs='EPSG:5070'):
+    """
+    Intersect state and NERC polygons and return the fraction of each
+    state's area in each region (see state_nerc_overlap).
+    """
+    import numpy as np
+    import geopandas as gpd
+
+    nerc = gpd.read_file(nerc_path)
+    nerc = nerc.loc[nerc['NERC'] != '-', ['NERC', 'geometry']]
+    states = gpd.read_file(state_path)[['STUSPS', 'geometry']]
+
+    nerc = nerc.to_crs(crs).reset_index(drop=True)
+    states = states.to_crs(crs).reset_index(drop=True)
+    # Simplify before intersecting. Areas come from the simplified polygons
+    # too, so fractions are consistent.
+    nerc['geometry'] = nerc.geometry.simplify(tolerance,
+                                              preserve_topology=True)
+    states['geometry'] = states.geometry.simplify(tolerance,
+                                                  preserve_topology=True)
+
+    # Candidate pairs with overlapping bounding boxes from the spatial index,
+    # then exact intersections of only those pairs
+    state_idx, nerc_idx = nerc.sindex.query_bulk(states.geometry,
+                                                 predicate='intersects')
+    areas = (states.geometry.iloc[state_idx].reset_index(drop=True)
+                   .intersection(nerc.geometry.iloc[nerc_idx]
+                                     .reset_index(drop=True))
+                   .area
+                   .values)
+
+    state_names, state_codes = np.unique(states['STUSPS'].values,
+                                         return_inverse=True)
+    nerc_names, nerc_codes = np.unique(nerc['NERC'].values,
+                                       return_inverse=True)
+    # A state or region can be made of several polygons
+    state_area = np.bincount(state_codes, weights=states.geometry.area.values,
+                             minlength=len(state_names))
+    shared = np.zeros((len(state_names), len(nerc_names)))
+    np.add.at(shared, (state_codes[state_idx], nerc_codes[nerc_idx]), areas)
+
+    overlap = pd.DataFrame(shared / state_area[:, None],
+                           index=pd.Index(state_names, name='state'),
+                           columns=[str(x) for x in nerc_names])
+
+    return overlap
+
+def states_in_nerc(min_fraction=1e-3):
     """
     Function to create a file that will list all of the states in each of the
-    NERC regions.
+    NERC regions. Uses the cached area overlap from state_nerc_overlap.
+
+    inputs:
+        min_fraction (float): states are listed in a region if more than
+            this fraction of the state's area is in the region. Areas come
+            from simplified polygons, so slivers along shared borders have
+            a small area; the default leaves out states that only touch a
+            region.
 
     output:
         JSON file that lists all states in each NERC region
     """
     import json
-    import geopandas as gpd
-    # from shapely.geometry import Point
-    from geopandas import GeoDataFrame
 
     # Get the project top-level path
     ap = abspath(__file__)
     top_path = getParentDir(dirname(ap), level=2)
 
-    # Read NERC shapefile
-    nerc_path = join(top_path, 'Data storage', 'NERC_Regions_EIA',
-                'NercRegions_201610.shp')
-    nerc = gpd.read_file(nerc_path)
-
-    state_path = join(top_path, 'Data storage', 'cb_2016_us_state_500k',
-                    'cb_2016_us_state_500k.shp')
-    states = gpd.read_file(state_path)
-    state_cols = ['STUSPS', 'geometry']
-    nerc_cols = ['NERC', 'geometry']
+    overlap = state_nerc_overlap()
 
-    df = gpd.sjoin(states[state_cols], nerc.loc[nerc['NERC'] != '-', nerc_cols])
-
-    s = pd.DataFrame(columns=['NERC', 'state'])
-    s['NERC'] = df.loc[:, 'NERC'].values
-    s['state'] = df.loc[:, 'STUSPS'].values
-
-    # Still need to output s to a file.
     state_dict = {}
-
-    for NERC in s['NERC'].unique():
-        state_dict[NERC] = s.loc[s['NERC'] == NERC, 'state'].tolist()
+    for NERC in overlap.columns:
+        in_nerc = overlap[NERC] > min_fraction
+        state_dict[NERC] = overlap.index[in_nerc].tolist()
 
     json_path = join(top_path, 'Data storage', 'Derived data',
                     'NERC_states.json')
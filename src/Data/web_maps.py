@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+from os.path import join, abspath, dirname
+from util.utils import getParentDir
+from Data.make_data import shapefile_paths
+
+INDEX_COLS = ['index (g/kwh)', 'index (lb/mwh)', 'change since 2005']
+
+
+def index_properties(index_df, region_col, year=None, value_cols=None,
+                     decimals=3):
+    """
+    Annual index values for each region in a single year, to embed as map
+    properties.
+
+    Monthly results (with a 'month' column, e.g. the final NERC and state
+    files) are summed to annual co2 and generation with index_rollup, so the
+    annual index is total co2 / total generation. Annual results are used
+    as they are. A value column named 'index' (the NERC file) is treated as
+    'index (g/kwh)'.
+
+    inputs:
+        index_df (df): monthly or annual results with region_col, 'year',
+            and either value_cols or 'final co2 (kg)' and
+            'generation (mwh)' if they are monthly
+        region_col (str): column with region names
+        year (int): year of values to use. Defaults to the last year.
+        value_cols (list): columns to include. Defaults to the INDEX_COLS
+            in the (annual) results.
+        decimals (int): round values to keep the file size down
+
+    outputs:
+        df: region_col and the value columns for the year
+    """
+    from Analysis.index import index_rollup
+
+    if 'index' in index_df.columns and 'index (g/kwh)' not in index_df:
+        index_df = index_df.rename(columns={'index': 'index (g/kwh)'})
+
+    if 'month' in index_df.columns:
+        sum_cols = ['final co2 (kg)', 'generation (mwh)']
+        missing = [col for col in sum_cols if col not in index_df.columns]
+        if missing:
+            raise ValueError('Monthly results need {} columns to calculate '
+                             'the annual index'.format(', '.join(missing)))
+        index_df = index_rollup(index_df, resolutions=('annual',),
+                                group_by=[region_col])['annual']
+
+    if value_cols is None:
+        value_cols = [col for col in INDEX_COLS if col in index_df.columns]
+    if not value_cols:
+        raise ValueError('No index columns ({}) were found'.format(
+            ', '.join(INDEX_COLS)))
+    if year is None:
+        year = index_df['year'].max()
+
+    df = index_df.loc[index_df['year'] == year, [region_col] + value_cols]
+    df = df.groupby(region_col, as_index=False).first()
+    df[value_cols] = df[value_cols].round(decimals)
+    df['year'] = int(year)
+
+    return df
+
+
+def export_topojson(gdf, out_folder, name, tolerances=(1000, 5000, 20000),
+                    quantization=1e5, crs='EPSG:2163'):
+    """
+    Write a quantized and simplified TopoJSON file for each tolerance.
+    Shared borders are stored once as arcs and simplified together, so
+    neighboring regions don't have gaps or overlaps at any tolerance.
+
+    inputs:
+        gdf (GeoDataFrame): polygons and any properties to keep
+        out_folder (str): folder for the files
+        name (str): object name in the TopoJSON, also used for file names
+            ('{name} {tolerance}.json')
+        tolerances (list): simplification tolerances in units of crs
+            (meters), e.g. one for each zoom level
+        quantization (float): number of quantized positions along each axis
+        crs (str): projection for the output coordinates
+
+    outputs:
+        list: paths of the files that were written
+    """
+    import topojson
+
+    gdf = gdf.to_crs(crs)
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    paths = []
+    for tolerance in tolerances:
+        topo = topojson.Topology(gdf, object_name=name, prequantize=False,
+                                 toposimplify=tolerance,
+                                 topoquantize=int(quantization))
+        path = join(out_folder, '{} {}.json'.format(name, tolerance))
+        topo.to_json(path)
+        paths.append(path)
+
+    return paths
+
+
+def export_web_maps(nerc_index, state_index, out_folder=None, year=None,
+                    tolerances=(1000, 5000, 20000), quantization=1e5,
+                    crs='EPSG:2163', nerc_path=None, state_path=None):
+    """
+    Export NERC region and state maps for the website as TopoJSON at
+    several tolerances, with index values as properties of each region.
+
+    inputs:
+        nerc_index (df): monthly or annual NERC results with 'nerc' and
+            'year' columns (see index_properties)
+        state_index (df): monthly or annual state results with 'state' and
+            'year' columns
+        out_folder (str): defaults to 'Data storage/Web maps'
+        year (int): year of index values for both maps. Defaults to the
+            last year that is in both nerc_index and state_index.
+        tolerances, quantization, crs: see export_topojson
+        nerc_path, state_path (str): shapefiles (see state_nerc_overlap)
+
+    outputs:
+        list: paths of the files that were written
+    """
+    import geopandas as gpd
+
+    if out_folder is None:
+        top_path = getParentDir(dirname(abspath(__file__)), level=2)
+        out_folder = join(top_path, 'Data storage', 'Web maps')
+
+    default_nerc, default_state = shapefile_paths()
+    nerc = gpd.read_file(nerc_path or default_nerc)
+    nerc = nerc.loc[nerc['NERC'] != '-', ['NERC', 'geometry']]
+    # Multiple polygons for a region are combined into one feature
+    nerc = nerc.dissolve(by='NERC').reset_index()
+    nerc.rename(columns={'NERC': 'nerc'}, inplace=True)
+    states = gpd.read_file(state_path or default_state)
+    states = states.loc[:, ['STUSPS', 'geometry']]
+    states.rename(columns={'STUSPS': 'state'}, inplace=True)
+
+    # Both maps show the same year
+    if year is None:
+        year = min(nerc_index['year'].max(), state_index['year'].max())
+
+    paths = []
+    for gdf, index_df, region_col, name in [
+            (nerc, nerc_index, 'nerc', 'nerc'),
+            (states, state_index, 'state', 'states')]:
+        props = index_properties(index_df, region_col, year)
+        gdf = gdf.merge(props, on=region_col, how='left')
+        paths.extend(export_topojson(gdf, out_folder, name, tolerances,
+                                     quantization, crs))
+
+    return paths
@@ -1,13 +1,13 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import matplotlib.lines as mlines
-import matplotlib.collections
 import pandas as pd
 import seaborn as sns
 import numpy as np
 from statsmodels.tsa.tsatools import detrend
 idx = pd.IndexSlice
 from os.path import join
+from Analysis.trends import trend_bands
 
 def region_facet_grid(df, plot_function, x_axis, y_axis, col_order=None,
                       suptitle='', add_legend=False, x_label=None,
@@ -31,11 +31,20 @@ def region_facet_grid(df, plot_function, x_axis, y_axis, col_order=None,
 
 def add_count(df):
     'Add a 0-indexed column for the regression line'
-    nercs = df['variable'].unique()
-    for nerc in nercs:
-        df.loc[df['variable'] == nerc, 'count'] = range(
-                                            len(df.loc[df['variable'] == nerc])
-                                                        )
+    df['count'] = df.groupby('variable').cumcount()
+
+def trend_band_plot(x, trend, lower, upper, color=None, label=None,
+                    fill_alpha=0.3, lw=2, **kwargs):
+    """
+    Draw a precomputed trend line and confidence band (from trend_bands) on
+    the current axis. Can be used with FacetGrid.map in place of regplot.
+    """
+    ax = plt.gca()
+    order = np.argsort(np.asarray(x))
+    x, trend, lower, upper = [np.asarray(a)[order]
+                              for a in (x, trend, lower, upper)]
+    ax.fill_between(x, lower, upper, color=color, alpha=fill_alpha, lw=0)
+    ax.plot(x, trend, color=color, lw=lw, **kwargs)
 
 def rolling_corr_plot(index, region_pairs, window, center=True,
                       order=None, legend_order=None, sup_title=None,
@@ -60,7 +69,7 @@ def rolling_corr_plot(index, region_pairs, window, center=True,
         annual (bool): use a linear regression detrend separately on each year
         seasonal (bool): detrend with a 12-month rolling mean
         shift (int): value of shift for the diff detrend method (1 = 1 month)
-        fill_alpha: alpha value for the 'fill_between' of regplot uncertainty
+        fill_alpha: alpha value for the 'fill_between' of trend uncertainty
     """
 
     df = index.copy()
@@ -122,6 +131,13 @@ def rolling_corr_plot(index, region_pairs, window, center=True,
     # Add the 0-indexed 'count' column
     add_count(corr_tidy)
 
+    # Linear trend and 95% confidence band of every region pair, fit in a
+    # single pass (regplot bootstraps each facet separately)
+    corr_tidy = corr_tidy.dropna()
+    corr_tidy = pd.concat([corr_tidy,
+                           trend_bands(corr_tidy, 'count', 'Correlation',
+                                       'variable')], axis=1)
+
     if not order:
         order = ['WECC', 'TRE', 'SPP', 'SERC', 'RFC', 'MRO']
 
@@ -129,14 +145,14 @@ def rolling_corr_plot(index, region_pairs, window, center=True,
         legend_order = ['SPP', 'TRE', 'SERC', 'MRO', 'FRCC', 'NPCC', 'WECC']
     legend_len = len(legend_order)
 
-    g = sns.FacetGrid(corr_tidy.dropna(), col='region1', col_wrap=2, aspect=1.2,
+    g = sns.FacetGrid(corr_tidy, col='region1', col_wrap=2, aspect=1.2,
                       hue='region2', palette='tab10', size=2,
                       hue_order=legend_order)
-    # Use regplot to get the regression line, but set scatter marker size to 0
-    g.map(sns.regplot, 'count', 'Correlation', scatter=False,#marker='.',
-          truncate=True, line_kws={'lw': 2})
+    # Precomputed trend lines and confidence bands
+    g.map(trend_band_plot, 'count', 'trend', 'trend lower', 'trend upper',
+          fill_alpha=fill_alpha)
 
-    # regplot only does a scatter - add plt.plot for the lines
+    # Add plt.plot for the correlation lines
     g.map(plt.plot, 'count', 'Correlation')
 
 
@@ -158,12 +174,6 @@ def rolling_corr_plot(index, region_pairs, window, center=True,
         ax.set_xticks(x_ticks)
         ax.set_xlim(12, None)
 
-        # find PolyCollection objects (confidence intervals for regplot) and
-        # change the alpha to make them darker
-        for collection in ax.collections:
-            if isinstance(collection, matplotlib.collections.PolyCollection):
-                collection.set_alpha(fill_alpha)
-
     # Year for the ticklabels
     g.set_xticklabels(years, rotation=35)
     g.set_xlabels('Year')
@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname
+
+# Modules are imported from src (e.g. `from util.utils import ...`)
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,36 @@
+import pytest
+from Data.bulk_index import series_to_df
+
+
+def test_series_to_df_mixed_frequencies():
+    lines = [{'series_id': 'ELEC.PLANT.GEN.388-WAT-ALL.M',
+              'data': [['201802', 5], ['201801', '4']]},
+             {'series_id': 'ELEC.PLANT.GEN.388-WAT-ALL.Q',
+              'data': [['2018Q1', 9]]},
+             {'series_id': 'ELEC.PLANT.GEN.388-WAT-ALL.A',
+              'data': [['2017', 50], ['2016', None]]}]
+
+    df = series_to_df(lines)
+
+    assert list(df['series_id'].str[-1]) == ['M', 'M', 'Q', 'A', 'A']
+    assert list(df['year']) == [2018, 2018, 2018, 2017, 2016]
+    assert list(df['month']) == [2, 1, 0, 0, 0]
+    assert list(df['quarter']) == [0, 0, 1, 0, 0]
+    assert list(df['value'].fillna(-1)) == [5, 4, 9, 50, -1]
+
+
+def test_series_to_df_annual_only():
+    lines = [{'series_id': 'ELEC.GEN.COW-AL-99.A', 'data': [['2017', 1]]}]
+
+    df = series_to_df(lines)
+
+    assert 'month' not in df.columns
+    assert 'quarter' not in df.columns
+    assert list(df['year']) == [2017]
+
+
+def test_series_to_df_unknown_period():
+    lines = [{'series_id': 'EBA.X.H', 'data': [['20180101T00Z', 1]]}]
+
+    with pytest.raises(ValueError):
+        series_to_df(lines)
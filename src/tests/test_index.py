@@ -0,0 +1,57 @@
+import pandas as pd
+import numpy as np
+from Analysis.index import index_rollup, update_index_rollup
+
+
+def make_monthly(seed=0):
+    'Two regions with monthly data from 2005 through 2007'
+    rng = np.random.RandomState(seed)
+    months = pd.MultiIndex.from_product([['A', 'B'], range(2005, 2008),
+                                         range(1, 13)],
+                                        names=['nerc', 'year', 'month'])
+    df = months.to_frame(index=False)
+    df['generation (mwh)'] = rng.uniform(50, 100, len(df))
+    df['final co2 (kg)'] = rng.uniform(20, 80, len(df))
+
+    return df
+
+
+def assert_results_equal(left, right):
+    assert sorted(left) == sorted(right)
+    for name in left:
+        pd.testing.assert_frame_equal(
+            left[name].reset_index(drop=True),
+            right[name].reset_index(drop=True),
+            check_dtype=False)
+
+
+def test_update_index_rollup_matches_full_rollup():
+    monthly = make_monthly()
+    # Stored results are missing the last 3 months of region A
+    last = (monthly['nerc'] == 'A') & (monthly['year'] == 2007)
+    last &= monthly['month'] >= 10
+    stored = index_rollup(monthly.loc[~last], group_by=['nerc'],
+                          rolling=True)
+
+    # New months plus revisions to 2005 and 2006 in region A
+    revised = monthly.copy()
+    revised_rows = ((revised['nerc'] == 'A')
+                    & revised['month'].isin([3])
+                    & revised['year'].isin([2005, 2006]))
+    revised.loc[revised_rows, 'final co2 (kg)'] *= 1.5
+    new_monthly = revised.loc[last | revised_rows]
+
+    updated = update_index_rollup(stored, new_monthly, group_by=['nerc'])
+    full = index_rollup(revised, group_by=['nerc'], rolling=True)
+
+    assert_results_equal(updated, full)
+
+
+def test_update_index_rollup_national():
+    monthly = make_monthly().groupby(['year', 'month'], as_index=False).sum()
+    monthly.drop(columns='nerc', inplace=True)
+    stored = index_rollup(monthly.iloc[:-2])
+
+    updated = update_index_rollup(stored, monthly.iloc[-2:])
+
+    assert_results_equal(updated, index_rollup(monthly))
@@ -0,0 +1,40 @@
+import pandas as pd
+import numpy as np
+from Analysis.regions import RegionMembership
+from Analysis.index import region_index
+
+
+def make_labels():
+    'Plant 2 moves from region A to B in 2017'
+    return pd.DataFrame({'plant id': [1, 2, 1, 2],
+                         'year': [2016, 2016, 2017, 2017],
+                         'nerc': ['A', 'A', 'A', 'B']})
+
+
+def test_matrix_years_outside_labels():
+    membership = RegionMembership.from_labels(make_labels(),
+                                              region_cols=['nerc'])
+
+    # Later years use the nearest earlier label year, and years before the
+    # labels use the latest year (the same as FacilityLabels)
+    assert (membership.matrix(2018) != membership.matrix(2017)).nnz == 0
+    assert (membership.matrix(2010) != membership.matrix(2017)).nnz == 0
+    assert (membership.matrix(2030) != membership.matrix(2017)).nnz == 0
+
+
+def test_region_index_after_last_label_year():
+    membership = RegionMembership.from_labels(make_labels(),
+                                              region_cols=['nerc'])
+    facility = pd.DataFrame({'plant id': [1, 2, 1, 2],
+                             'year': [2017, 2017, 2018, 2018],
+                             'month': [1, 1, 1, 1],
+                             'generation (mwh)': [10., 20., 10., 30.],
+                             'final co2 (kg)': [5., 20., 5., 15.]})
+
+    monthly = region_index(facility, membership,
+                           calc_change_since_2005=False)['monthly']
+    monthly = monthly.set_index(['region', 'year'])
+
+    assert np.isclose(monthly.loc[('B', 2018), 'index (g/kwh)'], 0.5)
+    assert np.isclose(monthly.loc[('A', 2018), 'generation (mwh)'], 10)
+    assert np.isclose(monthly.loc[('USA', 2018), 'final co2 (kg)'], 20)
@@ -0,0 +1,49 @@
+import pandas as pd
+import numpy as np
+from util.vintages import VintageStore
+
+
+def make_table():
+    return pd.DataFrame({'year': [2016, 2016, 2017, np.nan],
+                         'nerc': ['A', None, 'B', 'C'],
+                         'generation (mwh)': [1.5, 2., 3., 4.],
+                         'plants': [1, 2, 3, 4]})
+
+
+def test_round_trip(tmp_path):
+    store = VintageStore(str(tmp_path))
+    df = make_table()
+    store.save(df, 'National index', date='2018-03-01')
+
+    loaded = store.load('National index')
+
+    pd.testing.assert_frame_equal(loaded, df)
+
+
+def test_unchanged_chunks_are_shared(tmp_path):
+    store = VintageStore(str(tmp_path))
+    df = make_table()
+    store.save(df, 'National index', date='2018-03-01')
+    size = store.disk_usage()
+
+    # Only the 2017 partition changes
+    revised = df.copy()
+    revised.loc[2, 'generation (mwh)'] = 5.
+    store.save(revised, 'National index', date='2018-04-01')
+
+    assert store.vintages('National index') == ['2018-03-01', '2018-04-01']
+    assert store.disk_usage() - size < size / 2
+    pd.testing.assert_frame_equal(
+        store.load('National index', date='2018-03-15'), df)
+    pd.testing.assert_frame_equal(store.load('National index'), revised)
+
+
+def test_load_partitions(tmp_path):
+    store = VintageStore(str(tmp_path))
+    store.save(make_table(), 'National index', date='2018-03-01')
+
+    loaded = store.load('National index', columns=['nerc', 'plants'],
+                        partitions=[2017, np.nan])
+
+    assert list(loaded.columns) == ['nerc', 'plants']
+    assert list(loaded['plants']) == [3, 4]
@@ -0,0 +1,36 @@
+import pandas as pd
+import numpy as np
+import pytest
+from Data.web_maps import index_properties
+
+
+def test_monthly_results_use_annual_index():
+    monthly = pd.DataFrame({'year': [2017, 2017, 2017],
+                            'month': [1, 2, 1],
+                            'state': ['AL', 'AL', 'AK'],
+                            'final co2 (kg)': [300., 100., 50.],
+                            'generation (mwh)': [1., 3., 1.],
+                            'index (g/kwh)': [300., 33.3, 50.]})
+
+    props = index_properties(monthly, 'state').set_index('state')
+
+    assert np.isclose(props.loc['AL', 'index (g/kwh)'], 100)
+    assert np.isclose(props.loc['AK', 'index (g/kwh)'], 50)
+    assert (props['year'] == 2017).all()
+
+
+def test_nerc_index_column():
+    annual = pd.DataFrame({'year': [2016, 2017], 'nerc': ['SERC', 'SERC'],
+                           'index': [500., 450.]})
+
+    props = index_properties(annual, 'nerc')
+
+    assert list(props['index (g/kwh)']) == [450.]
+
+
+def test_no_value_columns():
+    annual = pd.DataFrame({'year': [2017], 'nerc': ['SERC'],
+                           'generation (mwh)': [1.]})
+
+    with pytest.raises(ValueError):
+        index_properties(annual, 'nerc')
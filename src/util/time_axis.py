@@ -0,0 +1,78 @@
+"""
+Shared time axis for monthly data. Months are stored as integer month
+ordinals (year * 12 + month - 1), which are used as the key for grouping,
+merging, and range filters. Ordinals are only converted to datetime for
+output and plotting.
+"""
+import pandas as pd
+import numpy as np
+
+# Month ordinal of January 1970 (month 0 of datetime64[M])
+EPOCH_ORDINAL = 1970 * 12
+
+
+def month_ordinal(year, month):
+    """
+    Integer month ordinals (year * 12 + month - 1) from year and month
+    values or arrays. Returns int32 values, or float values with NaN if any
+    years or months are missing.
+    """
+    year = pd.to_numeric(pd.Series(np.ravel(year)), errors='coerce').values
+    month = pd.to_numeric(pd.Series(np.ravel(month)), errors='coerce').values
+    ordinal = year.astype(float) * 12 + month.astype(float) - 1
+
+    if np.isnan(ordinal).any():
+        return ordinal
+
+    return ordinal.astype(np.int32)
+
+
+def ordinal_year(ordinal):
+    'Year of each month ordinal'
+    return np.asarray(ordinal) // 12
+
+
+def ordinal_month(ordinal):
+    'Month (1-12) of each month ordinal'
+    return np.asarray(ordinal) % 12 + 1
+
+
+def ordinal_quarter(ordinal):
+    'Quarter (1-4) of each month ordinal'
+    return np.asarray(ordinal) % 12 // 3 + 1
+
+
+def month_ordinal_to_datetime(ordinal):
+    'Convert an array of year * 12 + month - 1 values to datetime64'
+    ordinal = np.asarray(ordinal, dtype=np.int64)
+    return ((ordinal - EPOCH_ORDINAL).astype('datetime64[M]')
+                                     .astype('datetime64[ns]'))
+
+
+def datetime_to_month_ordinal(dt):
+    'Month ordinal of each datetime (any day or time in the month)'
+    dt = np.asarray(dt, dtype='datetime64[ns]')
+    return (dt.astype('datetime64[M]').astype(np.int64)
+            + EPOCH_ORDINAL).astype(np.int32)
+
+
+def month_range(start_year, end_year, months=range(1, 13)):
+    'Month ordinals for the given months in every year from start to end'
+    years = np.arange(start_year, end_year + 1)
+    return month_ordinal(np.repeat(years, len(months)),
+                         np.tile(list(months), len(years)))
+
+
+def date_hour_to_datetime(op_date, op_hour):
+    """
+    Datetime from CEMS OP_DATE (mm-dd-yyyy) strings and OP_HOUR values.
+    The date parts are sliced from the strings rather than parsed with a
+    date format.
+    """
+    date = pd.Series(op_date).astype(str)
+    dt = pd.to_datetime({'year': date.str[6:10].astype(int).values,
+                         'month': date.str[:2].astype(int).values,
+                         'day': date.str[3:5].astype(int).values}).values
+    hours = np.asarray(op_hour).astype(np.int64).astype('timedelta64[h]')
+
+    return (dt + hours).astype('datetime64[ns]')
@@ -1,12 +1,20 @@
 import os
 from os.path import join, normpath
 import pandas as pd
+import numpy as np
 
 def getParentDir(path, level=1):
     return normpath(join(path, *([".."] * level)))
 
-def rename_cols(df, custom=None):
-    'If custom, use the custom dictionary'
+def rename_cols(df, custom=None, inplace=True):
+    """
+    If custom, use the custom dictionary. Otherwise rename ORISPL_CODE to
+    plant id and make all columns lowercase. With inplace=False the original
+    df is left unchanged and a renamed (shallow) copy is returned.
+    """
+    if not inplace:
+        df = df.copy(deep=False)
+
     if custom:
         df.rename(columns=custom, inplace=True)
     else:
@@ -17,7 +25,7 @@ def rename_cols(df, custom=None):
         # Make all columns lowercase
         df.columns = df.columns.str.lower()
 
-    pass
+    return df
 
 def add_facility_location(df, label_df, labels=[], merge_how='left'):
     """
@@ -26,12 +34,16 @@ def add_facility_location(df, label_df, labels=[], merge_how='left'):
 
     inputs:
         df (df): a dataframe with plant ids
-        label_df (df): a dataframe with plant ids and other columns that
-            give the location info for the plant
+        label_df (df or FacilityLabels): a dataframe with plant ids and other
+            columns that give the location info for the plant, or a
+            FacilityLabels index built from one
         labels (list): one or more columns to add to the original dataframe
         merge_how (str): type of merge (inner, left, right)
     """
 
+    if isinstance(label_df, FacilityLabels):
+        return label_df.add_labels(df, labels, merge_how=merge_how)
+
     merge_cols = ['plant id'] + labels
 
     # columns to merge on
@@ -43,3 +55,189 @@ def add_facility_location(df, label_df, labels=[], merge_how='left'):
     df = df.merge(label_df.loc[:, merge_cols], on=on, how=merge_how)
 
     return df
+
+def take_labels(values, pos):
+    """
+    Values at each position, with NaN (or NaT) where the position is -1.
+    Integer and bool values are converted to float if any are missing.
+    """
+    values = np.asarray(values)
+    pos = np.asarray(pos)
+    missing = pos < 0
+    if not len(values):
+        return np.full(len(pos), np.nan, dtype=object)
+
+    out = np.take(values, np.maximum(pos, 0))
+    if missing.any():
+        if out.dtype.kind in 'iub':
+            out = out.astype(float)
+        elif out.dtype.kind not in 'fcmM':
+            out = out.astype(object)
+        if out.dtype.kind in 'mM':
+            out[missing] = out.dtype.type('NaT')
+        else:
+            out[missing] = np.nan
+
+    return out
+
+class FacilityLabels(object):
+    """
+    Index of facility labels (state, nerc, lat/lon, etc) that is built once
+    and then attaches labels to any dataframe with plant ids by array lookups
+    rather than a merge.
+
+    (plant id, year) pairs are mapped to rows of the label data through a
+    dense plant x year array. If a plant doesn't have a label for the
+    requested year (or the dataframe doesn't have a year column), the label
+    from the most recent year for that plant is used.
+
+    inputs:
+        label_df (df): dataframe with a 'plant id' column, an optional 'year'
+            column (without missing values), and one or more label columns
+    """
+
+    def __init__(self, label_df):
+        self.has_year = 'year' in label_df.columns
+        if self.has_year and label_df['year'].isnull().any():
+            raise ValueError('Missing years in the label data')
+        key = ['plant id', 'year'] if self.has_year else ['plant id']
+        label_df = (label_df.sort_values(key)
+                            .drop_duplicates(subset=key, keep='last')
+                            .reset_index(drop=True))
+
+        self.label_df = label_df
+        self.plant_ids, plant_pos = np.unique(label_df['plant id'].values,
+                                              return_inverse=True)
+
+        # EIA plant ids are small integers, so a direct lookup array from
+        # plant id to dense position is faster than a binary search.
+        self.id_map = None
+        if (np.issubdtype(self.plant_ids.dtype, np.integer)
+                and self.plant_ids.min() >= 0
+                and self.plant_ids.max() < 10**7):
+            self.id_map = np.full(self.plant_ids.max() + 1, -1, dtype=np.int64)
+            self.id_map[self.plant_ids] = np.arange(len(self.plant_ids))
+        rows = np.arange(len(label_df))
+
+        # Sorted by plant id and year, so the last row for each plant is the
+        # most recent year
+        self.latest = np.full(len(self.plant_ids), -1, dtype=np.int64)
+        self.latest[plant_pos] = rows
+
+        if self.has_year:
+            years = label_df['year'].values.astype(int)
+            self.first_year = years.min()
+            n_years = years.max() - self.first_year + 1
+            self.table = np.repeat(self.latest[:, None], n_years, axis=1)
+            self.table[plant_pos, years - self.first_year] = rows
+
+    @classmethod
+    def from_csv(cls, path, **kwargs):
+        'Build the index from a csv file (e.g. Facility locations_RF.csv)'
+        return cls(pd.read_csv(path, **kwargs))
+
+    def positions(self, plant_id, year=None):
+        """
+        Row positions in the label data for each plant id (and year). Plant
+        ids that aren't in the label data get a position of -1. Missing years
+        use the most recent label.
+        """
+        plant_id = np.asarray(plant_id)
+        if self.id_map is not None and np.issubdtype(plant_id.dtype,
+                                                     np.integer):
+            in_map = (plant_id >= 0) & (plant_id < len(self.id_map))
+            p = self.id_map[np.where(in_map, plant_id, 0)]
+            found = in_map & (p >= 0)
+            p = np.maximum(p, 0)
+        else:
+            p = np.searchsorted(self.plant_ids, plant_id)
+            p = np.minimum(p, len(self.plant_ids) - 1)
+            found = self.plant_ids[p] == plant_id
+
+        if year is None or not self.has_year:
+            pos = self.latest[p]
+        else:
+            year = np.asarray(year, dtype=float)
+            known = ~np.isnan(year)
+            y = (np.where(known, year, self.first_year).astype(int)
+                 - self.first_year)
+            in_range = known & (y >= 0) & (y < self.table.shape[1])
+            pos = np.where(in_range,
+                           self.table[p, np.clip(y, 0, self.table.shape[1] - 1)],
+                           self.latest[p])
+
+        return np.where(found, pos, -1)
+
+    def get(self, label, plant_id, year=None):
+        'Return an array of a single label for each plant id (and year)'
+        pos = self.positions(plant_id, year)
+
+        return take_labels(self.label_df[label].values, pos)
+
+    def add_labels(self, df, labels, merge_how='left'):
+        """
+        Return a copy of df with label columns added. Use merge_how='inner'
+        to drop rows for plants that aren't in the label data. Only 'left'
+        and 'inner' are supported.
+        """
+        if merge_how not in ('left', 'inner'):
+            raise ValueError("merge_how must be 'left' or 'inner', not "
+                             "{}".format(merge_how))
+        year = df['year'].values if 'year' in df.columns else None
+        pos = self.positions(df['plant id'].values, year)
+
+        if merge_how == 'inner':
+            df = df.loc[pos >= 0]
+            pos = pos[pos >= 0]
+
+        new_cols = {label: take_labels(self.label_df[label].values, pos)
+                    for label in labels}
+
+        return df.assign(**new_cols)
+
+def df_hash(df, index=False):
+    """
+    Return a short hex digest of the contents of a dataframe. Used as a key
+    for cached intermediate results.
+
+    inputs:
+        df (df): any dataframe
+        index (bool): include the index in the hash
+
+    outputs:
+        str: md5 hex digest
+    """
+    import hashlib
+
+    h = hashlib.md5()
+    h.update(str(list(df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=index).values.tobytes())
+
+    return h.hexdigest()
+
+def file_hash(path, chunk_size=2**20):
+    """
+    Return the md5 hex digest of a file on disk, read in chunks so that large
+    files (zip, shapefiles) are never fully loaded into memory.
+    """
+    import hashlib
+
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def get_cache_path(*names):
+    """
+    Return a path inside the 'Data storage/Cache' folder, creating the folder
+    if it doesn't exist.
+    """
+    top_path = getParentDir(os.path.dirname(os.path.abspath(__file__)),
+                            level=2)
+    path = join(top_path, 'Data storage', 'Cache')
+    if not os.path.exists(path):
+        os.mkdir(path)
+
+    return join(path, *names)
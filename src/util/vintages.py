@@ -0,0 +1,220 @@
+import os
+from os.path import join, abspath, dirname, exists
+import datetime
+import hashlib
+import json
+import zlib
+import pandas as pd
+import numpy as np
+from util.utils import getParentDir
+
+
+def encode_column(values):
+    """
+    Canonical bytes for an array of column values. Numeric, bool, and
+    datetime arrays are stored as raw bytes with their dtype, and anything
+    else (strings, mixed objects) as a json list with missing values (None
+    or NaN) as null. Equal values always give the same bytes, so the hash of
+    a chunk only depends on its content.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'biufcmM':
+        header = values.dtype.str
+        payload = np.ascontiguousarray(values).tobytes()
+    else:
+        header = 'json'
+        payload = json.dumps([None if pd.isnull(v) else v
+                              for v in values.tolist()],
+                             default=str).encode()
+
+    return header.encode() + b'\n' + payload
+
+
+def decode_column(data):
+    'Inverse of encode_column'
+    header, payload = data.split(b'\n', 1)
+    header = header.decode()
+    if header == 'json':
+        # Missing values are saved as null and restored as NaN
+        values = np.array(json.loads(payload.decode()), dtype=object)
+        values[pd.isnull(values)] = np.nan
+        return values
+
+    return np.frombuffer(payload, dtype=np.dtype(header)).copy()
+
+
+class VintageStore(object):
+    """
+    Content-addressed store for dated versions (vintages) of output tables.
+    Each table is split into partitions (e.g. years), and each column of a
+    partition is saved as a zlib-compressed chunk named by the sha256 hash of
+    its content. A vintage is a small json manifest that lists the chunks.
+    Chunks that don't change between vintages (most of the history) are only
+    stored once.
+
+    Layout of the store folder:
+        objects/ab/cdef...: compressed column chunks
+        manifests/<table name>/<date>.json: one manifest per vintage
+
+    inputs:
+        root (str): store folder. Defaults to 'Data storage/Vintages'.
+    """
+
+    def __init__(self, root=None):
+        if root is None:
+            top_path = getParentDir(dirname(abspath(__file__)), level=2)
+            root = join(top_path, 'Data storage', 'Vintages')
+        self.root = root
+
+    def _object_path(self, digest):
+        return join(self.root, 'objects', digest[:2], digest[2:])
+
+    def _manifest_path(self, name, date):
+        return join(self.root, 'manifests', name, '{}.json'.format(date))
+
+    def _write_chunk(self, values):
+        'Save a column chunk if it is new and return its hash'
+        data = encode_column(values)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not exists(path):
+            if not exists(dirname(path)):
+                os.makedirs(dirname(path))
+            # Write to a temporary file first so a partial chunk is never
+            # left under a valid hash
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(data))
+            os.replace(tmp_path, path)
+
+        return digest
+
+    def _read_chunk(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            return decode_column(zlib.decompress(f.read()))
+
+    def save(self, df, name, date=None, partition_col='year'):
+        """
+        Save a table as a new vintage. The dataframe index is not saved.
+        Partitions are stored in order of first appearance, so rows are
+        reloaded in the same order if df is sorted by partition_col. Rows
+        with a missing partition value are stored in their own partition
+        (value None) after the others. Missing values in object columns are
+        reloaded as NaN.
+
+        inputs:
+            df (df): table to save
+            name (str): table name (e.g. 'National index')
+            date (str or date): vintage date. Defaults to today.
+            partition_col (str): column to split chunks on. If None or not
+                in df, each column is a single chunk.
+
+        outputs:
+            str: path of the manifest
+        """
+        if date is None:
+            date = datetime.date.today()
+        date = pd.Timestamp(date).strftime('%Y-%m-%d')
+
+        df = df.reset_index(drop=True)
+        if partition_col is not None and partition_col in df.columns:
+            codes, values = pd.factorize(df[partition_col], sort=False)
+            parts = [(value.item() if hasattr(value, 'item') else value,
+                      np.flatnonzero(codes == i))
+                     for i, value in enumerate(values)]
+            # factorize gives missing values a code of -1
+            if (codes < 0).any():
+                parts.append((None, np.flatnonzero(codes < 0)))
+        else:
+            partition_col = None
+            parts = [(None, np.arange(len(df)))]
+
+        assert sum(len(rows) for _, rows in parts) == len(df)
+
+        partitions = []
+        for value, rows in parts:
+            part = df.iloc[rows]
+            chunks = {col: self._write_chunk(part[col].values)
+                      for col in df.columns}
+            partitions.append({'value': value, 'rows': len(rows),
+                               'chunks': chunks})
+
+        manifest = {'name': name,
+                    'date': date,
+                    'partition col': partition_col,
+                    'columns': [str(col) for col in df.columns],
+                    'dtypes': [str(dtype) for dtype in df.dtypes],
+                    'partitions': partitions}
+
+        path = self._manifest_path(name, date)
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=1, default=str)
+
+        return path
+
+    def vintages(self, name):
+        'Sorted dates of all vintages of a table'
+        folder = join(self.root, 'manifests', name)
+        if not exists(folder):
+            return []
+
+        return sorted(os.path.splitext(fn)[0] for fn in os.listdir(folder)
+                      if fn.endswith('.json'))
+
+    def load(self, name, date=None, columns=None, partitions=None):
+        """
+        Load a vintage of a table.
+
+        inputs:
+            name (str): table name
+            date (str or date): load the most recent vintage on or before
+                this date. Defaults to the latest vintage.
+            columns (list): only load these columns
+            partitions (list): only load these partition values (e.g. years).
+                Include NaN to load rows with a missing partition value.
+
+        outputs:
+            df: the saved table
+        """
+        dates = self.vintages(name)
+        if date is not None:
+            date = pd.Timestamp(date).strftime('%Y-%m-%d')
+            dates = [d for d in dates if d <= date]
+        if not dates:
+            raise KeyError('No vintage of {} on or before {}'.format(name,
+                                                                      date))
+
+        with open(self._manifest_path(name, dates[-1])) as f:
+            manifest = json.load(f)
+
+        dtypes = dict(zip(manifest['columns'], manifest['dtypes']))
+        columns = list(columns or manifest['columns'])
+        parts = manifest['partitions']
+        if partitions is not None:
+            partitions = list(partitions)
+            load_missing = any(pd.isnull(value) for value in partitions)
+            parts = [p for p in parts
+                     if (p['value'] is None and load_missing)
+                     or (p['value'] is not None and p['value'] in partitions)]
+
+        data = {}
+        for col in columns:
+            chunks = [self._read_chunk(p['chunks'][col]) for p in parts]
+            values = (np.concatenate(chunks) if chunks
+                      else np.array([], dtype=object))
+            try:
+                data[col] = pd.Series(values).astype(dtypes[col])
+            except (TypeError, ValueError):
+                data[col] = pd.Series(values)
+
+        return pd.DataFrame(data, columns=columns)
+
+    def disk_usage(self):
+        'Total size (bytes) of all stored chunks'
+        total = 0
+        for folder, _, files in os.walk(join(self.root, 'objects')):
+            total += sum(os.path.getsize(join(folder, fn)) for fn in files)
+
+        return total